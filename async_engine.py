@@ -0,0 +1,533 @@
+import asyncio
+import logging
+import tempfile
+from pathlib import Path
+from requests.utils import dict_from_cookiejar
+from tqdm import tqdm
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from common import AuthError, check_auth_error
+from cookie_pool import as_cookie_pool
+from disk_space import DiskSpace
+from download_book import (
+    api_url,
+    close_programm,
+    create_metadata_file,
+    download_cover as sync_download_cover,
+    get_book_folder,
+    get_book_folder_path,
+    get_book_info,
+    get_files_to_download,
+    get_headers,
+    get_missing_sizes,
+    sanitize_filename,
+)
+from permissions import apply_file_permissions
+from profiler import profile_stage
+from progress import get_progress
+from staging import WRITE_BUFFER_SIZE, commit_book, finish_file, get_work_folder
+from throughput import add_transferred
+from tg_sender import send_to_telegram, send_file_to_telegram
+
+logger = logging.getLogger(__name__)
+
+# Число одновременных загрузок файлов и книг
+DEFAULT_MAX_TRANSFERS = 8
+DEFAULT_MAX_BOOKS = 4
+CHUNK_SIZE = 64 * 1024
+CONNECT_TIMEOUT = 30
+READ_TIMEOUT = 60
+
+
+class DownloadError(Exception):
+    pass
+
+
+def check_aiohttp():
+    if aiohttp is None:
+        return (
+            "Для --engine aiohttp нужно установить пакет aiohttp: pip install aiohttp"
+        )
+    return ""
+
+
+def create_session(max_transfers):
+    # Общее время не ограничиваем: большие файлы качаются долго.
+    # Ограничиваем подключение и паузы между порциями данных.
+    timeout = aiohttp.ClientTimeout(
+        total=None, sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT
+    )
+    # Cookies передаются в каждом запросе: книги могут загружаться с разных аккаунтов
+    return aiohttp.ClientSession(
+        cookie_jar=aiohttp.DummyCookieJar(),
+        headers=get_headers(),
+        timeout=timeout,
+        connector=aiohttp.TCPConnector(limit=max_transfers * 2),
+    )
+
+
+async def gather_or_cancel(tasks):
+    # При ошибке в одной из задач отменяем остальные и дожидаемся их завершения
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+async def with_auth_retry(cookies, refresh, request):
+    """Выполняет request(cookies). При ошибке авторизации обновляет SID через
+    refresh(sid, error) и повторяет запрос, не прерывая остальные загрузки книги."""
+    sid = cookies.get("SID")
+    try:
+        return await request(dict_from_cookiejar(cookies))
+    except AuthError as e:
+        if refresh is None or not await refresh(sid, e):
+            raise
+    return await request(dict_from_cookiejar(cookies))
+
+
+async def get_json(session, cookies, url, refresh=None):
+    return await with_auth_retry(
+        cookies, refresh, lambda cookies_dict: _get_json(session, cookies_dict, url)
+    )
+
+
+async def _get_json(session, cookies, url):
+    async with session.get(url, cookies=cookies) as res:
+        if not res.ok:
+            err_msg = f"Ошибка: {res.status} ({await res.text()}) GET {url}"
+            check_auth_error(res.status, err_msg)
+            raise DownloadError(err_msg)
+        return await res.json(content_type=None)
+
+
+async def download_content_file(
+    session, transfers, cookies, url, path, filename, progress_bar, refresh=None
+):
+    full_filename = Path(path) / sanitize_filename(filename)
+    async with transfers:
+        logger.info(f"Загрузка файла: {url}")
+        with profile_stage("file transfer", concurrent=True):
+            await with_auth_retry(
+                cookies,
+                refresh,
+                lambda cookies_dict: _download_content_file(
+                    session, cookies_dict, url, full_filename, filename, progress_bar
+                ),
+            )
+    await asyncio.to_thread(apply_file_permissions, full_filename)
+
+
+async def _download_content_file(
+    session, cookies, url, full_filename, filename, progress_bar
+):
+    async with session.get(url, cookies=cookies) as res:
+        if not res.ok:
+            err_msg = f"Ошибка: {res.status} ({await res.text()}) файл: {url}"
+            check_auth_error(res.status, err_msg)
+            raise DownloadError(err_msg)
+        total_size = res.content_length or 0
+        bar = None
+        # При общей сводке байты учитываются в ней, индикатор на файл не нужен
+        progress = get_progress()
+        if progress_bar and progress is None:
+            bar = tqdm(total=total_size, unit="B", unit_scale=True, desc=filename)
+        size = 0
+        # Запись на диск (особенно сетевой) не должна останавливать остальные
+        # загрузки цикла событий: файл открывается и записывается в отдельном
+        # потоке, блоками по WRITE_BUFFER_SIZE, а не по каждому фрагменту ответа
+        f = await asyncio.to_thread(
+            open, full_filename, "wb", buffering=WRITE_BUFFER_SIZE
+        )
+        try:
+            chunks = []
+            buffered = 0
+            async for data in res.content.iter_chunked(CHUNK_SIZE):
+                chunks.append(data)
+                buffered += len(data)
+                size += len(data)
+                if progress is not None:
+                    progress.add_bytes(len(data))
+                elif bar is not None:
+                    bar.update(len(data))
+                if buffered >= WRITE_BUFFER_SIZE:
+                    await asyncio.to_thread(f.writelines, chunks)
+                    chunks = []
+                    buffered = 0
+            if len(chunks) > 0:
+                await asyncio.to_thread(f.writelines, chunks)
+            await asyncio.to_thread(finish_file, f)
+        finally:
+            await asyncio.to_thread(f.close)
+            if bar is not None:
+                bar.close()
+        if total_size != 0 and size != total_size:
+            raise DownloadError(f"Не удалось загрузить файл: {url}")
+        add_transferred(size)
+
+
+async def download_cover(transfers, book_folder, book_info):
+    # Обложка загружается через общий кеш обложек (cover_cache), как и в
+    # download_book.py, поэтому запрос выполняется в отдельном потоке
+    async with transfers:
+        with profile_stage("cover", concurrent=True):
+            await asyncio.to_thread(sync_download_cover, book_folder, book_info)
+
+
+async def download_book_async(
+    session,
+    transfers,
+    cookies,
+    url,
+    output,
+    tg_api_key,
+    tg_chat_id,
+    progress_bar,
+    load_cover,
+    create_metadata,
+    send_fb2_via_telegram,
+    disk_space,
+    refresh=None,
+):
+    """Тот же порядок, что и в download_book.download_book: метаданные, список
+    файлов, обложка, OPF, файлы. Файлы книги загружаются одновременно, не более
+    transfers за раз. refresh(sid, error) - обновление истекшего SID в cookies.
+    Возвращает False, если книга отложена из-за нехватки места"""
+    book_id = url.split("-")[-1].split("/")[0]
+
+    url_string = api_url + book_id
+    with profile_stage("arts metadata", concurrent=True):
+        json_data = await get_json(session, cookies, url_string, refresh)
+    book_info = get_book_info(json_data["payload"]["data"])
+
+    url_string = url_string + "/files/grouped"
+    with profile_stage("grouped listing", concurrent=True):
+        json_data = await get_json(session, cookies, url_string, refresh)
+    files = get_files_to_download(book_id, json_data["payload"]["data"])
+    del json_data
+
+    # Файлы, загруженные при прошлом запуске, места не требуют. Обращения к
+    # файловой системе выполняются в отдельном потоке, как и запись файлов
+    book_folder = get_book_folder_path(output, book_info)
+    work_folder = get_work_folder(output, book_folder)
+    complete, missing_size, output_size = await asyncio.to_thread(
+        get_missing_sizes, work_folder, book_folder, files
+    )
+    book_size = sum(file[2] for file in files)
+    if not await asyncio.to_thread(
+        disk_space.try_reserve, book_id, missing_size, output_size
+    ):
+        return False
+
+    progress = get_progress()
+    if progress is not None:
+        progress.start_book(url, book_info["title"], book_size, len(files))
+    files_done = 0
+    try:
+        msg = f"Начало загрузки книги:\n{book_info['title']}\nавтор: {book_info['author']}"
+        logger.debug(msg)
+        await asyncio.to_thread(send_to_telegram, msg, tg_api_key, tg_chat_id)
+
+        with profile_stage("folder creation", concurrent=True):
+            await asyncio.to_thread(get_book_folder, output, book_info)
+        logger.info(f"Загрузка файлов в каталог: {work_folder}")
+
+        tasks = []
+        if load_cover:
+            tasks.append(
+                asyncio.create_task(download_cover(transfers, work_folder, book_info))
+            )
+        if create_metadata:
+            with profile_stage("opf", concurrent=True):
+                await asyncio.to_thread(create_metadata_file, work_folder, book_info)
+
+        async def download_file(file_url, filename, file_size, done):
+            nonlocal files_done
+            if done:
+                logger.info(f"Файл уже загружен: {filename}")
+                if progress is not None:
+                    progress.skip_bytes(file_size)
+            else:
+                await download_content_file(
+                    session,
+                    transfers,
+                    cookies,
+                    file_url,
+                    work_folder,
+                    filename,
+                    progress_bar,
+                    refresh,
+                )
+                await asyncio.to_thread(disk_space.consume, book_id, file_size)
+            files_done += 1
+            if progress is not None:
+                progress.update_book(url, book_info["title"], files_done, len(files))
+
+        for (file_url, filename, file_size, is_fb2), done in zip(files, complete):
+            tasks.append(
+                asyncio.create_task(download_file(file_url, filename, file_size, done))
+            )
+        await gather_or_cancel(tasks)
+        await asyncio.to_thread(commit_book, work_folder, book_folder)
+    finally:
+        # Блокировка резерва может быть общей с другими процессами
+        await asyncio.to_thread(disk_space.release, book_id)
+    if progress is not None:
+        progress.finish_book(url)
+
+    if send_fb2_via_telegram and tg_api_key != "" and tg_chat_id != "":
+        fb2_files = [file for file in files if file[3]]
+        for file_url, filename, file_size, is_fb2 in fb2_files:
+            full_filename = Path(book_folder) / filename
+            await asyncio.to_thread(
+                send_file_to_telegram, full_filename, tg_api_key, tg_chat_id
+            )
+        # Если отправили файл в телеграм, нет смысла дополнительно
+        # сообщать об успешной загрузке.
+        if len(fb2_files) > 0:
+            return True
+
+    msg = (
+        f"Окончание загрузки книги:\n{book_info['title']}\nавтор: {book_info['author']}"
+    )
+    logger.debug(msg)
+    await asyncio.to_thread(send_to_telegram, msg, tg_api_key, tg_chat_id)
+    return True
+
+
+async def _download_book(
+    url,
+    output,
+    cookies,
+    tg_api_key,
+    tg_chat_id,
+    progress_bar,
+    load_cover,
+    create_metadata,
+    send_fb2_via_telegram,
+    disk_space,
+    max_transfers,
+):
+    async with create_session(max_transfers) as session:
+        return await download_book_async(
+            session,
+            asyncio.Semaphore(max_transfers),
+            cookies,
+            url,
+            output,
+            tg_api_key,
+            tg_chat_id,
+            progress_bar,
+            load_cover,
+            create_metadata,
+            send_fb2_via_telegram,
+            disk_space,
+        )
+
+
+def download_book(
+    url,
+    output,
+    cookies,
+    tg_api_key,
+    tg_chat_id,
+    progress_bar,
+    load_cover,
+    create_metadata,
+    send_fb2_via_telegram,
+    disk_space=None,
+    max_transfers=DEFAULT_MAX_TRANSFERS,
+):
+    """Синхронная обертка с той же сигнатурой, что и download_book.download_book"""
+    err_msg = check_aiohttp()
+    if err_msg != "":
+        logger.error(err_msg)
+        close_programm(err_msg, tg_api_key, tg_chat_id)
+    if disk_space is None:
+        disk_space = DiskSpace(output)
+    try:
+        return asyncio.run(
+            _download_book(
+                url,
+                output,
+                cookies,
+                tg_api_key,
+                tg_chat_id,
+                progress_bar,
+                load_cover,
+                create_metadata,
+                send_fb2_via_telegram,
+                disk_space,
+                max_transfers,
+            )
+        )
+    except (DownloadError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+        err_msg = str(e) or f"Ошибка загрузки: {url}"
+        logger.error(err_msg)
+        close_programm(err_msg, tg_api_key, tg_chat_id)
+
+
+async def _download_books(
+    input,
+    output,
+    cookies,
+    tg_api_key,
+    tg_chat_id,
+    progressbar,
+    load_cover,
+    create_metadata,
+    disk_space,
+    max_books,
+    max_transfers,
+):
+    cookie_pool = as_cookie_pool(cookies)
+    async with create_session(max_transfers) as session:
+        transfers = asyncio.Semaphore(max_transfers)
+        # Ограничиваем число книг в работе, чтобы память не зависела от длины очереди
+        books = asyncio.Semaphore(max_books)
+        running = set()
+        errors = []
+
+        async def download_with_pool(url):
+            # При ошибке авторизации, которую не исправило обновление SID,
+            # исключаем cookies из пула и повторяем загрузку со следующими.
+            # Уже загруженные файлы книги повторно не скачиваются.
+            while True:
+                cookie_session = cookie_pool.acquire()
+                if cookie_session is None:
+                    raise DownloadError(
+                        f"Не осталось действующих cookies для загрузки: {url}"
+                    )
+
+                async def refresh(sid, error):
+                    # Отказ в доступе к одной книге обновлением SID не исправить
+                    if not await asyncio.to_thread(
+                        cookie_pool.is_session_error, cookie_session, error
+                    ):
+                        return False
+                    return await asyncio.to_thread(
+                        cookie_pool.refresh, cookie_session, sid
+                    )
+
+                try:
+                    return await download_book_async(
+                        session,
+                        transfers,
+                        cookie_session.cookies,
+                        url,
+                        output,
+                        tg_api_key,
+                        tg_chat_id,
+                        progressbar,
+                        load_cover,
+                        create_metadata,
+                        False,
+                        disk_space,
+                        refresh,
+                    )
+                except AuthError as e:
+                    if not await asyncio.to_thread(
+                        cookie_pool.is_session_error, cookie_session, e
+                    ):
+                        raise DownloadError(str(e))
+                    cookie_pool.drop(cookie_session, str(e))
+                finally:
+                    cookie_pool.release(cookie_session)
+
+        async def run(url, deferred):
+            try:
+                logger.info(f"Адрес к загрузке: {url}")
+                if not await download_with_pool(url):
+                    logger.warning(f"Загрузка отложена: {url}")
+                    deferred.write(url + "\n")
+            except (DownloadError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                errors.append(str(e) or f"Ошибка загрузки: {url}")
+                progress = get_progress()
+                if progress is not None:
+                    progress.finish_book(url, ok=False)
+            finally:
+                books.release()
+
+        async def run_queue(urls, deferred):
+            for url in urls:
+                url = url.strip()
+                if "litres.ru" not in url:
+                    continue
+                await books.acquire()
+                if len(errors) > 0:
+                    books.release()
+                    break
+                task = asyncio.create_task(run(url, deferred))
+                running.add(task)
+                task.add_done_callback(running.discard)
+            await gather_or_cancel(list(running))
+            if len(errors) > 0:
+                raise DownloadError(errors[0])
+
+        # Книги, которым не хватило места, откладываются до конца очереди
+        with tempfile.TemporaryFile("w+") as deferred:
+            with open(input, "r") as f:
+                await run_queue(f, deferred)
+            deferred.seek(0)
+            with tempfile.TemporaryFile("w+") as not_loaded:
+                await run_queue(deferred, not_loaded)
+                not_loaded.seek(0)
+                return [url.strip() for url in not_loaded]
+
+
+def download_books(
+    input,
+    output,
+    cookies,
+    tg_api_key,
+    tg_chat_id,
+    progressbar,
+    load_cover,
+    create_metadata,
+    disk_space=None,
+    max_books=DEFAULT_MAX_BOOKS,
+    max_transfers=DEFAULT_MAX_TRANSFERS,
+):
+    """Синхронная обертка с той же сигнатурой, что и multiloader.download_books.
+    cookies - одиночные cookies или CookiePool"""
+    err_msg = check_aiohttp()
+    if err_msg != "":
+        logger.error(err_msg)
+        close_programm(err_msg, tg_api_key, tg_chat_id)
+    if disk_space is None:
+        disk_space = DiskSpace(output)
+    try:
+        not_loaded = asyncio.run(
+            _download_books(
+                input,
+                output,
+                cookies,
+                tg_api_key,
+                tg_chat_id,
+                progressbar,
+                load_cover,
+                create_metadata,
+                disk_space,
+                max_books,
+                max_transfers,
+            )
+        )
+    except DownloadError as e:
+        logger.error(str(e))
+        close_programm(str(e), tg_api_key, tg_chat_id)
+
+    if len(not_loaded) > 0:
+        err_msg = (
+            f"Недостаточно места в каталоге {output}. Не загружены книги:\n"
+            + "\n".join(not_loaded)
+        )
+        logger.error(err_msg)
+        send_to_telegram(err_msg, tg_api_key, tg_chat_id)
+    return not_loaded
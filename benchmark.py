@@ -0,0 +1,622 @@
+import argparse
+import json
+import logging
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+from http.cookies import SimpleCookie
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import Process
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+BENCH_SID = "benchmark-sid"
+BENCH_TG_API_KEY = "benchmark"
+BENCH_TG_CHAT_ID = "1"
+# Число разных авторов в тестовой очереди
+AUTHORS = 10
+
+
+class FakeLitresHandler(BaseHTTPRequestHandler):
+    """Локальная замена api.litres.ru, www.litres.ru и api.telegram.org"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_json(self, status):
+        self.send_json({"error": {"code": status, "title": "Fake error"}}, status)
+
+    def send_bytes(self, size, content_type, headers={}):
+        config = self.server.config
+        start, end = 0, size - 1
+        range_header = self.headers.get("Range", "")
+        if config["range"] and range_header.startswith("bytes="):
+            first, _, last = range_header[6:].partition("-")
+            start = int(first) if first else 0
+            end = min(int(last), size - 1) if last else size - 1
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        if config["range"]:
+            self.send_header("Accept-Ranges", "bytes")
+        length = end - start + 1
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(length))
+        self.end_headers()
+
+        chunk = self.server.chunk
+        bandwidth = config["bandwidth"]
+        began = time.perf_counter()
+        sent = 0
+        while sent < length:
+            part = chunk[: min(len(chunk), length - sent)]
+            self.wfile.write(part)
+            sent += len(part)
+            if bandwidth > 0:
+                delay = sent / bandwidth - (time.perf_counter() - began)
+                if delay > 0:
+                    time.sleep(delay)
+
+    def is_failed(self):
+        return self.server.random.random() < self.server.config["error_rate"]
+
+    def get_sid(self):
+        cookie = SimpleCookie(self.headers.get("Cookie", ""))
+        return cookie["SID"].value if "SID" in cookie else ""
+
+    def is_unauthorized(self):
+        # После expire_sid_after запросов к API и файлам сессия BENCH_SID истекает,
+        # как истекает SID посреди долгой загрузки. Сессии, полученные повторной
+        # авторизацией, действуют до конца
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            if 0 < server.config.get("expire_sid_after", 0) < server.requests:
+                server.expired.add(BENCH_SID)
+            return self.get_sid() in server.expired
+
+    def is_forbidden(self, book_id):
+        # Каждая forbidden_every книга как будто не входит в подписку: 403 на файлы
+        # при действующей сессии
+        forbidden_every = self.server.config.get("forbidden_every", 0)
+        return forbidden_every > 0 and int(book_id) % forbidden_every == 0
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        if length > 0:
+            self.rfile.read(length)
+
+    def do_GET(self):
+        config = self.server.config
+        if config["latency"] > 0:
+            time.sleep(config["latency"])
+
+        parts = [part for part in self.path.split("?")[0].split("/") if part]
+        if len(parts) == 0:
+            # Главная страница для проверки cookies. С истекшей сессией ссылки
+            # на профиль нет
+            if self.get_sid() in self.server.expired:
+                body = '<a href="/auth/login/">login</a>'.encode()
+            else:
+                body = '<a href="/me/profile/">profile</a>'.encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif (
+            parts[:3] == ["foundation", "api", "arts"]
+            or parts[0] == "download_book_subscr"
+        ) and self.is_unauthorized():
+            self.send_error_json(401)
+        elif parts[:3] == ["foundation", "api", "arts"] and len(parts) == 4:
+            if self.is_failed():
+                self.send_error_json(500)
+            else:
+                self.send_json({"payload": {"data": fake_arts(parts[3])}})
+        elif parts[:3] == ["foundation", "api", "arts"] and parts[4:] == [
+            "files",
+            "grouped",
+        ]:
+            if self.is_failed():
+                self.send_error_json(500)
+            else:
+                self.send_json({"payload": {"data": fake_grouped(parts[3], config)}})
+        elif parts[0] == "download_book_subscr" and self.is_forbidden(parts[1]):
+            self.send_error_json(403)
+        elif parts[0] == "download_book_subscr":
+            if self.is_failed():
+                self.send_error_json(500)
+            else:
+                self.send_bytes(config["file_size"], "audio/mpeg")
+        elif parts[0] == "pub":
+            # Обложки поддерживают условные запросы, как CDN litres
+            etag = f'"{parts[-1]}-{config["cover_size"]}"'
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+            else:
+                self.send_bytes(config["cover_size"], "image/jpeg", {"ETag": etag})
+        else:
+            self.send_error_json(404)
+
+    def do_POST(self):
+        self.read_body()
+        if self.path.startswith("/bot"):
+            self.send_json({"ok": True, "result": {}})
+        elif self.path == "/foundation/api/auth/login-available":
+            # Новая сессия для авторизации (create_cookies.login)
+            body = b"{}"
+            self.send_response(200)
+            self.send_header("request-session-id", f"fresh-{time.time_ns()}")
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif self.path == "/foundation/api/auth/login":
+            self.send_json({"payload": {"data": {}}})
+        else:
+            self.send_error_json(404)
+
+
+def fake_arts(book_id):
+    return {
+        "url": f"/audiobook/avtor-{int(book_id) % AUTHORS}/kniga-{book_id}/",
+        "id": int(book_id),
+        "title": f"Тестовая книга {book_id}",
+        "cover_url": f"/pub/c/cover/{book_id}.jpg",
+        "html_annotation": "<p>Аннотация&nbsp;тестовой книги.</p>" * 50,
+        "isbn": "978-5-00000-000-0",
+        "publication_date": "2024-01-01",
+        "uuid": f"00000000-0000-0000-0000-{int(book_id):012d}",
+        "persons": [
+            {
+                "full_name": f"Иван Иванович Тестов-{int(book_id) % AUTHORS}",
+                "role": "author",
+            },
+            {"full_name": "Пётр Чтецов", "role": "reader"},
+        ],
+        "genres": [{"name": "Фантастика"}],
+        "series": [{"name": "Тестовая серия", "arts_count": 10, "art_order": 1}],
+        "tags": [{"name": "Тест"}],
+    }
+
+
+def fake_grouped(book_id, config):
+    files = [
+        {
+            "id": int(book_id) * 1000 + num,
+            "filename": f"{book_id}_{num:03d}.mp3",
+            "extension": "mp3",
+            "size": config["file_size"],
+        }
+        for num in range(config["files_per_book"])
+    ]
+    return [{"file_type": "standard_quality_mp3", "files": files}]
+
+
+def serve(host, port, config):
+    server = ThreadingHTTPServer((host, port), FakeLitresHandler)
+    server.daemon_threads = True
+    server.config = config
+    server.random = random.Random(config["seed"])
+    server.lock = threading.Lock()
+    server.requests = 0
+    server.expired = set()
+    server.chunk = b"\0" * 65536
+    server.serve_forever()
+
+
+def get_free_port(host):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_server(host, port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection((host, port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"Тестовый сервер {host}:{port} не запустился")
+
+
+def start_fake_server(config, host="127.0.0.1"):
+    """Запускает тестовый сервер в отдельном процессе и настраивает адреса в окружении.
+    Модули загрузчика нужно импортировать после вызова этой функции."""
+    port = get_free_port(host)
+    process = Process(target=serve, args=(host, port, config), daemon=True)
+    process.start()
+    wait_for_server(host, port)
+    base_url = f"http://{host}:{port}"
+    for name in ["LITRES_URL", "LITRES_WWW_URL", "LITRES_API_URL", "TELEGRAM_API_URL"]:
+        os.environ[name] = base_url
+    return process
+
+
+def create_queue(filename, books, first_book_id=10000):
+    with open(filename, "w") as f:
+        for book_id in range(first_book_id, first_book_id + books):
+            f.write(
+                f"https://www.litres.ru/audiobook/avtor-{book_id % AUTHORS}/kniga-{book_id}/\n"
+            )
+
+
+# Обход через os.walk, а не rglob: rglob запоминает все найденные пути,
+# и на 100000 книгах память бенчмарка (max_rss_mb) росла бы вместе с очередью
+def folder_size(folder):
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, files in os.walk(folder)
+        for name in files
+    )
+
+
+def count_books(folder):
+    """Число каталогов с файлами mp3"""
+    return sum(
+        1
+        for _, _, files in os.walk(folder)
+        if any(name.endswith(".mp3") for name in files)
+    )
+
+
+def get_max_rss_mb(who="self"):
+    """who="children" - наибольший из завершенных дочерних процессов
+    (процессы sharded_loader)"""
+    if resource is None:
+        return 0
+    if who == "children":
+        rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    else:
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # В macOS значение в байтах, в linux в килобайтах
+    if sys.platform == "darwin":
+        return rss / 1024 / 1024
+    return rss / 1024
+
+
+def get_children_cpu():
+    if resource is None:
+        return 0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def create_cookies_file(output):
+    """Файл cookies с сохраненными данными для входа, чтобы истекший SID
+    (--expire-sid-after) обновлялся так же, как при обычной загрузке"""
+    cookies_file = Path(output) / "cookies.json"
+    cookies_file.write_text(json.dumps({"SID": BENCH_SID}))
+    cookies_file.with_suffix(".credentials.json").write_text(
+        json.dumps({"user": "benchmark", "password": "benchmark"})
+    )
+    return cookies_file
+
+
+def run_benchmark(
+    mode,
+    engine,
+    processes,
+    books,
+    output,
+    tg_api_key,
+    tg_chat_id,
+    cover,
+    metadata,
+):
+    # Импорт после запуска сервера, чтобы модули прочитали адреса из окружения
+    from common import AuthError
+    from cookie_pool import load_cookie_pool, download_with_pool
+
+    if engine == "aiohttp":
+        from async_engine import download_book, download_books
+    else:
+        from download_book import download_book
+        from multiloader import download_books
+    from sharded_loader import download_books_sharded
+
+    Path(output).mkdir(exist_ok=True, parents=True)
+    queue_file = Path(output) / "queue.txt"
+    create_queue(queue_file, books)
+    book_folder = Path(output) / "books"
+
+    errors = 0
+    books_done = 0
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    children_cpu_start = get_children_cpu()
+
+    cookies = load_cookie_pool([create_cookies_file(output)], tg_api_key, tg_chat_id)
+    if mode == "sharded":
+        download_books_sharded(
+            queue_file,
+            book_folder,
+            cookies,
+            tg_api_key,
+            tg_chat_id,
+            False,
+            cover,
+            metadata,
+            processes,
+            engine,
+        )
+        books_done = count_books(book_folder)
+    elif mode == "multiloader":
+        try:
+            download_books(
+                queue_file,
+                book_folder,
+                cookies,
+                tg_api_key,
+                tg_chat_id,
+                False,
+                cover,
+                metadata,
+            )
+        except (SystemExit, AuthError):
+            errors += 1
+        # Загрузка прерывается на первой ошибке, книга с ошибкой не считается
+        books_done = max(0, count_books(book_folder) - errors)
+    else:
+        with open(queue_file, "r") as f:
+            for url in f:
+                try:
+                    download_with_pool(
+                        cookies,
+                        download_book,
+                        url.strip(),
+                        book_folder,
+                        tg_api_key,
+                        tg_chat_id,
+                        False,
+                        cover,
+                        metadata,
+                        False,
+                    )
+                    books_done += 1
+                except (SystemExit, AuthError):
+                    errors += 1
+
+    wall = time.perf_counter() - wall_start
+    # В режиме sharded книги загружают дочерние процессы, их время тоже учитываем
+    cpu = time.process_time() - cpu_start + get_children_cpu() - children_cpu_start
+    total_bytes = folder_size(book_folder)
+    report = {
+        "mode": mode,
+        "engine": engine,
+        "processes": processes if mode == "sharded" else 1,
+        "books": books,
+        "books_done": books_done,
+        "errors": errors,
+        "wall_sec": round(wall, 3),
+        "cpu_sec": round(cpu, 3),
+        "books_per_min": round(books_done / wall * 60, 2) if wall > 0 else 0,
+        "mb_per_sec": round(total_bytes / 1024 / 1024 / wall, 2) if wall > 0 else 0,
+        "total_mb": round(total_bytes / 1024 / 1024, 2),
+        "max_rss_mb": round(get_max_rss_mb(), 1),
+    }
+    if mode == "sharded":
+        # max_rss_mb - только родительский процесс
+        report["max_rss_workers_mb"] = round(get_max_rss_mb("children"), 1)
+    return report
+
+
+def check_regression(report, baseline, max_regression):
+    err_msgs = []
+    for key in ["books_per_min", "mb_per_sec"]:
+        if baseline.get(key, 0) > 0:
+            change = (report[key] - baseline[key]) / baseline[key] * 100
+            if change < -max_regression:
+                err_msgs.append(
+                    f"Регрессия {key}: {report[key]} против {baseline[key]} ({change:.1f}%)"
+                )
+    return err_msgs
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        level=logging.ERROR,
+    )
+    parser = argparse.ArgumentParser(
+        description="Воспроизводимый замер производительности загрузчика на локальном тестовом сервере"
+    )
+    parser.add_argument(
+        "--mode",
+        help="Что замерять: download_book для каждой книги, multiloader.download_books или sharded_loader.download_books_sharded",
+        choices=["download_book", "multiloader", "sharded"],
+        default="multiloader",
+    )
+    parser.add_argument(
+        "--engine",
+        help="Способ загрузки: requests или aiohttp",
+        choices=["requests", "aiohttp"],
+        default="requests",
+    )
+    parser.add_argument(
+        "--processes", help="Число процессов для --mode sharded", type=int, default=4
+    )
+    parser.add_argument("--books", help="Количество книг", type=int, default=20)
+    parser.add_argument(
+        "--files-per-book", help="Количество файлов в книге", type=int, default=5
+    )
+    parser.add_argument(
+        "--file-size", help="Размер файла в байтах", type=int, default=1024 * 1024
+    )
+    parser.add_argument(
+        "--cover-size", help="Размер обложки в байтах", type=int, default=100 * 1024
+    )
+    parser.add_argument(
+        "--latency", help="Задержка ответа сервера в секундах", type=float, default=0
+    )
+    parser.add_argument(
+        "--bandwidth",
+        help="Ограничение скорости отдачи на соединение, байт/с. 0 - без ограничения",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--error-rate",
+        help="Доля запросов к API и файлам, завершающихся ошибкой 500 (0..1)",
+        type=float,
+        default=0,
+    )
+    parser.add_argument(
+        "--range",
+        help="Поддерживать|Не поддерживать заголовок Range",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+    )
+    parser.add_argument("--seed", help="Зерно генератора ошибок", type=int, default=0)
+    parser.add_argument(
+        "--expire-sid-after",
+        help=(
+            "SID истекает после стольких запросов к API и файлам: загрузчик должен "
+            "повторно авторизоваться и продолжить. 0 - не истекает"
+        ),
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--forbidden-every",
+        help=(
+            "Каждая N-я книга отвечает 403 на загрузку файлов при действующей сессии "
+            "(книга не входит в подписку). 0 - таких книг нет"
+        ),
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--telegram",
+        help="Отправлять|Не отправлять сообщения в телеграм (тестовый сервер)",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+    )
+    parser.add_argument(
+        "--cover",
+        help="Загружать|Не загружать обложку",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+    )
+    parser.add_argument(
+        "--metadata",
+        help="Создавать|Не создавать файл метаданных",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="Каталог для загрузки. По умолчанию временный каталог, удаляемый после замера",
+        default="",
+    )
+    parser.add_argument(
+        "--profile",
+        help="Вывести отчет о времени по этапам загрузки",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+    )
+    parser.add_argument("--report", help="Сохранить результаты в json файл", default="")
+    parser.add_argument(
+        "--baseline", help="json файл с результатами предыдущего замера", default=""
+    )
+    parser.add_argument(
+        "--max-regression",
+        help="Допустимое падение производительности относительно --baseline в процентах",
+        type=float,
+        default=10,
+    )
+    args = parser.parse_args()
+
+    config = {
+        "files_per_book": args.files_per_book,
+        "file_size": args.file_size,
+        "cover_size": args.cover_size,
+        "latency": args.latency,
+        "bandwidth": args.bandwidth,
+        "error_rate": args.error_rate,
+        "range": args.range,
+        "seed": args.seed,
+        "expire_sid_after": args.expire_sid_after,
+        "forbidden_every": args.forbidden_every,
+    }
+    server_process = start_fake_server(config)
+    if args.profile:
+        from profiler import enable_profiling
+
+        enable_profiling()
+
+    tg_api_key = BENCH_TG_API_KEY if args.telegram else ""
+    tg_chat_id = BENCH_TG_CHAT_ID if args.telegram else ""
+
+    try:
+        if args.output:
+            report = run_benchmark(
+                args.mode,
+                args.engine,
+                args.processes,
+                args.books,
+                args.output,
+                tg_api_key,
+                tg_chat_id,
+                args.cover,
+                args.metadata,
+            )
+        else:
+            with tempfile.TemporaryDirectory() as output:
+                report = run_benchmark(
+                    args.mode,
+                    args.engine,
+                    args.processes,
+                    args.books,
+                    output,
+                    tg_api_key,
+                    tg_chat_id,
+                    args.cover,
+                    args.metadata,
+                )
+    finally:
+        server_process.terminate()
+
+    report["config"] = config
+    for key, value in report.items():
+        print(f"{key}: {value}")
+    if args.report:
+        Path(args.report).write_text(json.dumps(report, indent=2))
+
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text())
+        err_msgs = check_regression(report, baseline, args.max_regression)
+        for err_msg in err_msgs:
+            logger.error(err_msg)
+        if len(err_msgs) > 0:
+            exit(1)
@@ -1,5 +1,6 @@
 import requests
 import logging
+import os
 from requests.utils import cookiejar_from_dict
 from pathlib import Path
 
@@ -9,16 +10,49 @@ except ImportError:
     import http.cookiejar as cookielib
 import json
 from tg_sender import send_to_telegram
+from profiler import profile_stage
 
 LITRES_DOMAIN_NAME = "litres.ru"
+# Адреса сервисов можно переопределить переменными окружения.
+# Используется в benchmark.py для работы с локальным тестовым сервером.
+LITRES_URL = os.environ.get("LITRES_URL", f"https://{LITRES_DOMAIN_NAME}")
+LITRES_WWW_URL = os.environ.get("LITRES_WWW_URL", f"https://www.{LITRES_DOMAIN_NAME}")
+LITRES_API_URL = os.environ.get("LITRES_API_URL", f"https://api.{LITRES_DOMAIN_NAME}")
 logger = logging.getLogger(__name__)
+# Коды ответа, которые могут означать, что cookies больше не действуют.
+# 403 бывает и отказом в доступе к одной книге (например, книга не входит
+# в подписку), поэтому при 403 cookies проверяются отдельно (CookiePool)
+AUTH_ERROR_CODES = (401, 403)
+
+
+class AuthError(Exception):
+    def __init__(self, err_msg, status_code=401):
+        super().__init__(err_msg)
+        self.status_code = status_code
+        # Результат проверки cookies после ответа 403. None - не проверялись
+        self.session_error = None
+
+
+def check_auth_error(status_code, err_msg):
+    # При ошибке авторизации не завершаем программу, а даем вызывающему сменить cookies
+    if status_code in AUTH_ERROR_CODES:
+        raise AuthError(err_msg, status_code)
+
+
+def get_error_description(res):
+    # Тело ответа с ошибкой не всегда JSON (например, страница прокси или CDN)
+    try:
+        return f"({str(res.json())})"
+    except ValueError:
+        return ""
 
 
 def cookies_is_valid(cookies, tg_api_key, tg_chat_id):
 
     err_msg = ""
-    url_string = f"https://{LITRES_DOMAIN_NAME}"
-    res = requests.get(url_string, cookies=cookies)
+    url_string = LITRES_URL
+    with profile_stage("cookie validation"):
+        res = requests.get(url_string, cookies=cookies)
     if res.ok:
         ref_string = "/me/profile/"
         content_list = res.text.split(ref_string)
@@ -29,8 +63,10 @@ def cookies_is_valid(cookies, tg_api_key, tg_chat_id):
             logger.error(err_msg)
             send_to_telegram(err_msg, tg_api_key, tg_chat_id)
     else:
-        err_msg = f"Ошибка: {res.status_code} ({str(res.json())}) GET {url_string} \
+        err_msg = (
+            f"Ошибка: {res.status_code} {get_error_description(res)} GET {url_string} \
                 Ошибка авторизации по файлу cookies"
+        )
         logger.error(err_msg)
         send_to_telegram(err_msg, tg_api_key, tg_chat_id)
     return err_msg
@@ -1,5 +1,21 @@
 import argparse
 import logging
+from profiler import enable_profiling
+from disk_space import DEFAULT_RESERVE_MB
+from progress import DEFAULT_REFRESH
+from cover_cache import (
+    DEFAULT_COVER_CACHE,
+    DEFAULT_COVER_CACHE_SIZE_MB,
+    set_cover_cache,
+)
+from staging import FSYNC_NONE, FSYNC_FILE, FSYNC_BOOK, set_staging
+from file_policy import PRESETS, DEFAULT_POLICY, file_policy_arg, set_file_policy
+from permissions import (
+    DEFAULT_FILE_MODE,
+    DEFAULT_DIR_MODE,
+    octal_mode,
+    set_permissions,
+)
 
 
 def create_common_args_without_url(app_description):
@@ -33,7 +49,124 @@ def create_common_args_without_url(app_description):
         action=argparse.BooleanOptionalAction,
         default=False,
     )
+    parser.add_argument(
+        "--files",
+        help=(
+            f"Какие файлы книги загружать: набор правил ({', '.join(PRESETS)}) или json файл "
+            "со списком правил вида "
+            '{"group": "*standard_quality_mp3*", "extensions": ["mp3"], "pick": "all|largest|smallest"}. '
+            f"По умолчанию: {DEFAULT_POLICY} (mp3 стандартного качества и fb2)"
+        ),
+        type=file_policy_arg,
+        default=DEFAULT_POLICY,
+    )
+    parser.add_argument(
+        "--cover-cache",
+        help=(
+            "Каталог кеша обложек. Обложка, уже загруженная ранее, перепроверяется "
+            "условным запросом и повторно не скачивается. Пустая строка - без кеша. "
+            f"По умолчанию: {DEFAULT_COVER_CACHE}"
+        ),
+        default=str(DEFAULT_COVER_CACHE),
+    )
+    parser.add_argument(
+        "--cover-cache-size",
+        help=(
+            "Ограничение размера кеша обложек в МБ. При превышении удаляются давно "
+            "не использованные обложки, а неиспользуемые 30 дней удаляются всегда. "
+            f"По умолчанию: {DEFAULT_COVER_CACHE_SIZE_MB}"
+        ),
+        type=int,
+        default=DEFAULT_COVER_CACHE_SIZE_MB,
+    )
     parser.add_argument("-o", "--output", help="Путь к папке загрузки", default=".")
+    parser.add_argument(
+        "--staging-dir",
+        help=(
+            "Локальный каталог, в который загружается книга перед переносом в каталог "
+            "загрузки. В каталоге загрузки (например, на сетевом диске) книга появляется "
+            "целиком, без частично загруженных файлов. По умолчанию не используется"
+        ),
+        default="",
+    )
+    parser.add_argument(
+        "--fsync",
+        help=(
+            "Сброс файлов на диск: none - не выполнять, file - после каждого файла, "
+            "book - один раз для всех файлов книги перед переносом. По умолчанию: none"
+        ),
+        choices=[FSYNC_NONE, FSYNC_FILE, FSYNC_BOOK],
+        default=FSYNC_NONE,
+    )
+    parser.add_argument(
+        "--engine",
+        help=(
+            "Способ загрузки: requests - последовательно, aiohttp - асинхронно, "
+            "несколько файлов одновременно (требуется пакет aiohttp). По умолчанию: requests"
+        ),
+        choices=["requests", "aiohttp"],
+        default="requests",
+    )
+    parser.add_argument(
+        "--max-transfers",
+        help="Максимальное число одновременно загружаемых файлов для --engine aiohttp. По умолчанию: 8",
+        type=int,
+        default=8,
+    )
+    parser.add_argument(
+        "--reserve-space",
+        help=(
+            "Минимальный запас свободного места в каталоге загрузки, МБ. "
+            "Книги, которым не хватает места, откладываются. "
+            f"По умолчанию: {DEFAULT_RESERVE_MB}"
+        ),
+        type=int,
+        default=DEFAULT_RESERVE_MB,
+    )
+    parser.add_argument(
+        "--file-mode",
+        help=f"Права на загруженные файлы (восьмеричное число). По умолчанию: {DEFAULT_FILE_MODE:o}",
+        type=octal_mode,
+        default=DEFAULT_FILE_MODE,
+    )
+    parser.add_argument(
+        "--dir-mode",
+        help=f"Права на каталог книги (восьмеричное число). По умолчанию: {DEFAULT_DIR_MODE:o}",
+        type=octal_mode,
+        default=DEFAULT_DIR_MODE,
+    )
+    parser.add_argument(
+        "--umask",
+        help="umask процесса (восьмеричное число). По умолчанию не изменяется",
+        type=octal_mode,
+        default=None,
+    )
+    parser.add_argument(
+        "--status-file",
+        help=(
+            "Файл, в который раз в --progress-refresh секунд записывается состояние загрузки "
+            "в формате json (объем, книги, скорость, оставшееся время, книги в работе). "
+            "По умолчанию не создается"
+        ),
+        default="",
+    )
+    parser.add_argument(
+        "--progress-refresh",
+        help="Период обновления хода загрузки (--progressbar) и --status-file, секунд. По умолчанию: 1",
+        type=float,
+        default=DEFAULT_REFRESH,
+    )
+    parser.add_argument(
+        "--profile",
+        help="Замерять время по этапам загрузки и вывести отчет при завершении",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+    )
+    parser.add_argument(
+        "--profile-pstats",
+        help="Дополнительно записать результаты cProfile в указанный файл (требуется --profile)",
+        default="",
+    )
     return parser
 
 
@@ -59,6 +192,14 @@ def parse_args(parser, logger, check_url=True):
 
     logger.setLevel(log_level)
 
+    set_permissions(args.file_mode, args.dir_mode, args.umask)
+    set_cover_cache(args.cover_cache, args.cover_cache_size * 1024 * 1024)
+    set_file_policy(args.files)
+    set_staging(args.staging_dir, args.fsync)
+
+    if args.profile:
+        enable_profiling(args.profile_pstats)
+
     if check_url:
         if len(args.url) == 0:
             logger.error("Не задан ключ --url")
@@ -0,0 +1,194 @@
+import json
+import logging
+import threading
+from pathlib import Path
+from requests.utils import cookiejar_from_dict, dict_from_cookiejar
+
+from common import AuthError, cookies_is_valid
+from create_cookies import refresh_cookies
+
+logger = logging.getLogger(__name__)
+
+ROUND_ROBIN = "round-robin"
+LEAST_LOAD = "least-load"
+
+
+def read_sid(cookies_file):
+    try:
+        return json.loads(Path(cookies_file).read_text()).get("SID", "")
+    except (OSError, ValueError):
+        return ""
+
+
+class CookieSession:
+    __slots__ = ("name", "cookies", "cookies_file", "active", "jobs")
+
+    def __init__(self, name, cookies, cookies_file=""):
+        self.name = name
+        self.cookies = cookies
+        # Файл, из которого прочитаны cookies. Нужен для обновления SID
+        self.cookies_file = cookies_file
+        self.active = 0
+        self.jobs = 0
+
+
+class CookiePool:
+    """Набор cookies нескольких аккаунтов. Задания распределяются по кругу
+    (round-robin) или на наименее загруженную сессию (least-load). Сессия с
+    ошибкой авторизации обновляется, если сохранены данные для входа, иначе
+    исключается из пула, и загрузка продолжается на остальных."""
+
+    def __init__(self, sessions, strategy=ROUND_ROBIN, refresh_lock=None):
+        self.sessions = list(sessions)
+        self.strategy = strategy
+        self.next = 0
+        self.lock = threading.Lock()
+        # В sharded_loader общая для процессов блокировка: пока один процесс
+        # авторизуется, остальные ждут и затем читают новый SID из файла
+        self.refresh_lock = refresh_lock or threading.Lock()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def acquire(self, job=True):
+        """job=False - вспомогательный запрос (предзагрузка метаданных): сессия
+        выбирается так же, но очередь round-robin не сдвигается и задание не
+        учитывается, чтобы книги распределялись между аккаунтами как без него"""
+        with self.lock:
+            if len(self.sessions) == 0:
+                return None
+            if self.strategy == LEAST_LOAD:
+                session = min(self.sessions, key=lambda s: (s.active, s.jobs))
+            else:
+                session = self.sessions[self.next % len(self.sessions)]
+                if job:
+                    self.next += 1
+            session.active += 1
+            if job:
+                session.jobs += 1
+            return session
+
+    def release(self, session):
+        with self.lock:
+            session.active -= 1
+
+    def is_session_error(self, session, error):
+        """True, если AuthError error относится к сессии, а не к одной книге.
+        После ответа 403 cookies проверяются запросом к сайту: если они
+        действуют, отказ относится только к книге, и сессию не обновляем и не
+        исключаем. Результат сохраняется в error, чтобы не проверять повторно."""
+        if error.status_code != 403:
+            return True
+        if error.session_error is None:
+            error.session_error = cookies_is_valid(session.cookies, "", "") != ""
+        return error.session_error
+
+    def drop(self, session, reason=""):
+        with self.lock:
+            if session in self.sessions:
+                self.sessions.remove(session)
+                logger.error(
+                    f"Cookies {session.name} исключены из работы: {reason}. "
+                    f"Осталось сессий: {len(self.sessions)}"
+                )
+
+    def refresh(self, session, failed_sid):
+        """Обновляет SID сессии по сохраненным данным авторизации (create_cookies.py
+        --save-credentials). cookies обновляются на месте, поэтому запросы, которые
+        уже используют эту сессию, продолжат работу с новым SID. Если SID уже
+        отличается от failed_sid, сессию обновил другой поток, и повторно не
+        авторизуемся. Возвращает True при успехе."""
+        if session.cookies_file == "":
+            return False
+        with self.refresh_lock:
+            if session.cookies.get("SID") != failed_sid:
+                return True
+            # Другой процесс загрузки (sharded_loader) мог уже авторизоваться
+            # и перезаписать файл cookies
+            SID = read_sid(session.cookies_file)
+            if SID != "" and SID != failed_sid:
+                session.cookies.set("SID", SID)
+                logger.warning(
+                    f"Cookies {session.name} прочитаны из обновленного файла"
+                )
+                return True
+            SID = refresh_cookies(session.cookies_file)
+            if SID == "":
+                return False
+            session.cookies.set("SID", SID)
+            logger.warning(f"Обновлены cookies {session.name}")
+            return True
+
+    def to_dicts(self):
+        with self.lock:
+            return [
+                (s.name, s.cookies_file, dict_from_cookiejar(s.cookies))
+                for s in self.sessions
+            ]
+
+    @classmethod
+    def from_dicts(
+        cls, cookies_dicts, strategy=ROUND_ROBIN, start=0, refresh_lock=None
+    ):
+        pool = cls(
+            [
+                CookieSession(name, cookiejar_from_dict(d), cookies_file)
+                for name, cookies_file, d in cookies_dicts
+            ],
+            strategy,
+            refresh_lock,
+        )
+        pool.next = start
+        return pool
+
+
+def as_cookie_pool(cookies):
+    """Функции загрузки принимают как пул, так и одиночные cookies"""
+    if isinstance(cookies, CookiePool):
+        return cookies
+    return CookiePool([CookieSession("cookies", cookies)])
+
+
+def load_cookie_pool(cookies_files, tg_api_key, tg_chat_id, strategy=ROUND_ROBIN):
+    """Читает файлы cookies и один раз проверяет каждый. В пул попадают только
+    действующие cookies."""
+    sessions = []
+    for cookies_file in cookies_files:
+        if not Path(cookies_file).is_file():
+            logger.error(f"Не найден файл с cookies: {cookies_file}")
+            continue
+        logger.info(f"Попытка извлечь cookies из файла {cookies_file}")
+        cookies = cookiejar_from_dict(json.loads(Path(cookies_file).read_text()))
+        if cookies_is_valid(cookies, tg_api_key, tg_chat_id) == "":
+            sessions.append(
+                CookieSession(str(cookies_file), cookies, str(cookies_file))
+            )
+    return CookiePool(sessions, strategy)
+
+
+def download_with_pool(pool, download, url, output, *args, **kwargs):
+    """Вызывает download(url, output, cookies, ...) с cookies из пула.
+    При ошибке авторизации SID сессии обновляется, если сохранены данные для входа,
+    и загрузка повторяется. Иначе сессия исключается и загрузка повторяется на
+    следующей."""
+    while True:
+        session = pool.acquire()
+        if session is None:
+            raise AuthError(f"Не осталось действующих cookies для загрузки: {url}")
+        try:
+            refreshed = False
+            while True:
+                sid = session.cookies.get("SID")
+                try:
+                    return download(url, output, session.cookies, *args, **kwargs)
+                except AuthError as e:
+                    if not pool.is_session_error(session, e):
+                        # Отказ в доступе к книге: это ошибка загрузки книги
+                        raise
+                    # Если и с новым SID ошибка авторизации, больше не обновляем
+                    if refreshed or not pool.refresh(session, sid):
+                        pool.drop(session, str(e))
+                        break
+                    refreshed = True
+        finally:
+            pool.release(session)
@@ -0,0 +1,230 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import requests
+
+from common import get_error_description
+from profiler import profile_stage
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_COVER_CACHE = Path.home() / ".cache" / "litres_audiobooks_downloader" / "covers"
+# Сколько секунд обложка из кеша считается актуальной без повторной проверки на сервере
+COVER_MAX_AGE = 24 * 60 * 60
+# Обложки, не использованные дольше этого срока, удаляются из кеша
+COVER_CACHE_TTL = 30 * 24 * 60 * 60
+# Ограничение размера кеша по умолчанию, МБ
+DEFAULT_COVER_CACHE_SIZE_MB = 200
+# Кеш проверяется на превышение размера после записи такой доли ограничения
+PRUNE_EVERY = 0.1
+# Число блокировок для ключей кеша
+LOCK_STRIPES = 64
+
+# Пустая строка - кеш отключен, обложка загружается напрямую, как раньше
+_cache_dir = ""
+_max_size = DEFAULT_COVER_CACHE_SIZE_MB * 1024 * 1024
+# Байт записано в кеш с последней очистки. None - очистки еще не было
+_written = None
+_prune_lock = threading.Lock()
+# Одно соединение на поток вместо нового соединения для каждой обложки
+_local = threading.local()
+# Блокировки по ключу кеша: предзагрузка и загрузка книги не качают обложку дважды.
+# Постоянный набор блокировок, выбираемых по ключу, чтобы память не росла с очередью
+_locks = [threading.Lock() for num in range(LOCK_STRIPES)]
+
+
+def set_cover_cache(cache_dir="", max_size=DEFAULT_COVER_CACHE_SIZE_MB * 1024 * 1024):
+    global _cache_dir, _max_size, _written
+    _cache_dir = str(cache_dir) if cache_dir else ""
+    _max_size = max_size
+    _written = None
+    logger.debug(
+        f"Кеш обложек: {_cache_dir or 'отключен'}, ограничение {_max_size} байт"
+    )
+
+
+def get_session():
+    if not hasattr(_local, "session"):
+        _local.session = requests.Session()
+    return _local.session
+
+
+def get_cache_key(url):
+    return hashlib.sha256(url.encode()).hexdigest()
+
+
+def _get_lock(key):
+    return _locks[int(key[:8], 16) % LOCK_STRIPES]
+
+
+def prune_cache():
+    """Удаляет обложки, не использованные дольше COVER_CACHE_TTL, и затем давно
+    не использованные, пока размер кеша превышает ограничение. Время
+    использования - время изменения файла обложки, оно обновляется при каждом
+    обращении к обложке."""
+    entries = []
+    total = 0
+    now = time.time()
+    for folder in Path(_cache_dir).glob("??"):
+        for data_file in folder.iterdir():
+            # Метаданные и недописанные временные файлы
+            if data_file.suffix != "" or data_file.name.startswith("."):
+                continue
+            try:
+                stat = data_file.stat()
+            except OSError:
+                continue
+            meta_file = data_file.with_suffix(".json")
+            if now - stat.st_mtime > COVER_CACHE_TTL:
+                _remove_entry(data_file, meta_file)
+                continue
+            entries.append((stat.st_mtime, stat.st_size, data_file, meta_file))
+            total += stat.st_size
+    entries.sort()
+    removed = 0
+    for mtime, size, data_file, meta_file in entries:
+        if total <= _max_size:
+            break
+        _remove_entry(data_file, meta_file)
+        total -= size
+        removed += 1
+    logger.debug(f"Кеш обложек: {total} байт, удалено по размеру: {removed}")
+
+
+def _remove_entry(data_file, meta_file):
+    # Файл мог удалить другой процесс, очищающий тот же кеш
+    data_file.unlink(missing_ok=True)
+    meta_file.unlink(missing_ok=True)
+
+
+def _add_written(size):
+    global _written
+    with _prune_lock:
+        # Первая запись после запуска тоже проверяет кеш: он мог остаться большим
+        # с прошлых запусков
+        if _written is not None and _written + size < _max_size * PRUNE_EVERY:
+            _written += size
+            return
+        _written = 0
+        prune_cache()
+
+
+def _touch(data_file):
+    try:
+        os.utime(data_file)
+    except OSError:
+        pass
+
+
+def _write_atomic(filename, data):
+    # Запись через временный файл: параллельные процессы не увидят половину обложки
+    with tempfile.NamedTemporaryFile(
+        dir=filename.parent, prefix=".tmp-", delete=False
+    ) as f:
+        f.write(data)
+    os.replace(f.name, filename)
+
+
+def _read_meta(meta_file):
+    try:
+        return json.loads(meta_file.read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def get_cached_cover(url):
+    """Возвращает путь к обложке в кеше, при необходимости загрузив ее.
+    Сохраненная обложка перепроверяется условным запросом (If-None-Match,
+    If-Modified-Since) не чаще раза в COVER_MAX_AGE секунд. Если сервер недоступен,
+    используется сохраненная копия. None - обложку получить не удалось."""
+    key = get_cache_key(url)
+    folder = Path(_cache_dir) / key[:2]
+    data_file = folder / key
+    meta_file = folder / f"{key}.json"
+    written = 0
+    with _get_lock(key):
+        meta = _read_meta(meta_file) if data_file.is_file() else {}
+        if (
+            meta.get("url") == url
+            and time.time() - meta.get("checked", 0) < COVER_MAX_AGE
+        ):
+            _touch(data_file)
+            return data_file
+
+        headers = {}
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+        try:
+            res = get_session().get(url, headers=headers)
+        except requests.RequestException as e:
+            logger.warning(f"Ошибка: {e} GET {url}")
+            return data_file if len(meta) > 0 else None
+
+        if res.status_code == 304 and len(meta) > 0:
+            logger.debug(f"Обложка не изменилась: {url}")
+            _touch(data_file)
+        elif res.ok:
+            folder.mkdir(exist_ok=True, parents=True)
+            _write_atomic(data_file, res.content)
+            written = len(res.content)
+            meta = {
+                "url": url,
+                "etag": res.headers.get("ETag", ""),
+                "last_modified": res.headers.get("Last-Modified", ""),
+            }
+        else:
+            logger.warning(
+                f"Ошибка: {res.status_code} {get_error_description(res)} GET {url}"
+            )
+            return data_file if len(meta) > 0 else None
+        meta["checked"] = time.time()
+        _write_atomic(meta_file, json.dumps(meta).encode())
+    if written > 0:
+        _add_written(written)
+    return data_file
+
+
+def prefetch_cover(url):
+    if _cache_dir == "":
+        return
+    # Предзагрузка идет в фоне одновременно с загрузкой файлов
+    with profile_stage("cover prefetch", concurrent=True):
+        get_cached_cover(url)
+
+
+def fetch_cover(url, filename):
+    """Сохраняет обложку в filename. Возвращает True при успехе"""
+    if _cache_dir != "":
+        cached = get_cached_cover(url)
+        if cached is None:
+            return False
+        try:
+            shutil.copyfile(cached, filename)
+            return True
+        except FileNotFoundError:
+            # Обложку удалила очистка кеша в другом процессе, загрузим напрямую
+            logger.debug(f"Обложка удалена из кеша: {url}")
+
+    try:
+        res = get_session().get(url, stream=True)
+    except requests.RequestException as e:
+        logger.warning(f"Ошибка: {e} GET {url}")
+        return False
+    if not res.ok:
+        logger.warning(
+            f"Ошибка: {res.status_code} {get_error_description(res)} GET {url}"
+        )
+        return False
+    res.raw.decode_content = True
+    with open(filename, "wb") as f:
+        shutil.copyfileobj(res.raw, f)
+    return True
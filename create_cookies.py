@@ -1,17 +1,26 @@
 import requests
 import logging
 import argparse
+import os
+import tempfile
 from pathlib import Path
 import json
 from tg_sender import send_to_telegram
-from common import LITRES_DOMAIN_NAME, cookies_is_valid
+from common import LITRES_DOMAIN_NAME, LITRES_API_URL, cookies_is_valid
 
 try:
     import cookielib
 except ImportError:
     import http.cookiejar as cookielib
 
+try:
+    import keyring
+    from keyring.errors import KeyringError
+except ImportError:
+    keyring = None
+
 logger = logging.getLogger(__name__)
+KEYRING_SERVICE = "litres_audiobooks_downloader"
 
 
 def to_cookielib_cookie(name, value, domain):
@@ -35,40 +44,123 @@ def to_cookielib_cookie(name, value, domain):
     )
 
 
-def create_cookies(user, password, cookies_file, tg_api_key, tg_chat_id):
-    url = f"https://api.{LITRES_DOMAIN_NAME}/foundation/api/auth/login-available"
+def login(user, password):
+    """Авторизация по имени пользователя и паролю. Возвращает (SID, err_msg)"""
+    url = f"{LITRES_API_URL}/foundation/api/auth/login-available"
     json_data = {"login": user}
     res = requests.post(url, json=json_data)
     if not res.ok:
-        msg = f"Oшибка {res.status_code} при обращении к URL: {url}"
-        logger.error(msg)
-        send_to_telegram(msg, tg_api_key, tg_chat_id)
-        exit(0)
+        return "", f"Oшибка {res.status_code} при обращении к URL: {url}"
 
     SID = res.headers["request-session-id"]
 
-    url = f"https://api.{LITRES_DOMAIN_NAME}/foundation/api/auth/login"
+    url = f"{LITRES_API_URL}/foundation/api/auth/login"
     headers = {"Session-Id": SID, "app-id": "115"}
     json_data = {"login": user, "password": password}
     res = requests.post(url, headers=headers, json=json_data)
     if not res.ok:
-        msg = (
+        return "", (
             f"Ошибка {res.status_code} при попытке авторизации {res.content.decode()} "
             f"url {url}"
         )
-        logger.error(msg)
-        send_to_telegram(msg, tg_api_key, tg_chat_id)
+    return SID, ""
+
+
+def write_cookies_file(cookies_file, cookies_dict):
+    # Пишем во временный файл и переименовываем: файл cookies читают другие
+    # процессы загрузки, они не должны увидеть его недописанным
+    folder = Path(cookies_file).absolute().parent
+    with tempfile.NamedTemporaryFile("w", dir=folder, delete=False) as f:
+        f.write(json.dumps(cookies_dict))
+    os.replace(f.name, cookies_file)
+
+
+def get_credentials_file(cookies_file):
+    return Path(cookies_file).with_suffix(".credentials.json")
+
+
+def save_credentials(cookies_file, user, password):
+    """Сохраняет данные для автоматического обновления cookies. Если установлен
+    keyring, пароль хранится в нем, а в файле только имя пользователя."""
+    credentials = {"user": user, "password": password}
+    if keyring is not None:
+        try:
+            keyring.set_password(KEYRING_SERVICE, user, password)
+            del credentials["password"]
+        except KeyringError as e:
+            # keyring установлен, но хранилище недоступно (например, на сервере
+            # без графического сеанса)
+            logger.warning(f"Не удалось сохранить пароль в keyring: {e}")
+    credentials_file = get_credentials_file(cookies_file)
+    # Файл создается сразу с правами 0600: пароль не должен оказаться
+    # в файле с правами по umask даже ненадолго
+    fd = os.open(credentials_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    # Права существующего файла open не меняет
+    os.chmod(credentials_file, 0o600)
+    with os.fdopen(fd, "w") as f:
+        f.write(json.dumps(credentials))
+    logger.info(f"Записан файл {credentials_file}")
+
+
+def load_credentials(cookies_file):
+    credentials_file = get_credentials_file(cookies_file)
+    if not credentials_file.is_file():
+        return "", ""
+    credentials = json.loads(credentials_file.read_text())
+    user = credentials.get("user", "")
+    password = credentials.get("password", "")
+    if password == "" and keyring is not None and user != "":
+        try:
+            password = keyring.get_password(KEYRING_SERVICE, user) or ""
+        except KeyringError as e:
+            logger.error(f"Не удалось прочитать пароль из keyring: {e}")
+    return user, password
+
+
+def refresh_cookies(cookies_file):
+    """Повторная авторизация с сохраненными данными и перезапись файла cookies.
+    Возвращает новый SID или пустую строку."""
+    user, password = load_credentials(cookies_file)
+    if user == "" or password == "":
+        logger.warning(f"Нет сохраненных данных для обновления cookies {cookies_file}")
+        return ""
+    try:
+        SID, err_msg = login(user, password)
+    except requests.RequestException as e:
+        # Обновление вызывается посреди загрузки очереди, сетевая ошибка
+        # не должна ее прерывать
+        err_msg = f"Ошибка при попытке авторизации: {e}"
+    if err_msg != "":
+        logger.error(err_msg)
+        return ""
+    cookies_dict = {}
+    if Path(cookies_file).is_file():
+        cookies_dict = json.loads(Path(cookies_file).read_text())
+    cookies_dict["SID"] = SID
+    write_cookies_file(cookies_file, cookies_dict)
+    logger.info(f"Обновлен файл {cookies_file}")
+    return SID
+
+
+def create_cookies(
+    user, password, cookies_file, tg_api_key, tg_chat_id, store_credentials=False
+):
+    SID, err_msg = login(user, password)
+    if err_msg != "":
+        logger.error(err_msg)
+        send_to_telegram(err_msg, tg_api_key, tg_chat_id)
         exit(0)
-        pass
 
     cookie_jar = cookielib.CookieJar()
     cookie_jar.set_cookie(to_cookielib_cookie("SID", SID, f"www.{LITRES_DOMAIN_NAME}"))
     err_msg = cookies_is_valid(cookie_jar, tg_api_key, tg_chat_id)
     if err_msg == "":
-        Path(args.cookies_file).write_text(json.dumps({"SID": SID}))
-        msg = f"Записан файл {args.cookies_file}"
+        write_cookies_file(cookies_file, {"SID": SID})
+        msg = f"Записан файл {cookies_file}"
         logger.info(msg)
         send_to_telegram(msg, tg_api_key, tg_chat_id)
+        if store_credentials:
+            save_credentials(cookies_file, user, password)
 
 
 if __name__ == "__main__":
@@ -104,6 +196,16 @@ if __name__ == "__main__":
         help=f"Не используется оставлен для совместимости",
         default="firefox",
     )
+    parser.add_argument(
+        "--save-credentials",
+        help=(
+            "Сохранить имя пользователя и пароль для автоматического обновления cookies "
+            "при их истечении во время загрузки. Пароль хранится в keyring (если установлен) "
+            "или в файле {cookies-file}.credentials.json рядом с cookies"
+        ),
+        action=argparse.BooleanOptionalAction,
+        default=False,
+    )
     args = parser.parse_args()
 
     logger.info(args)
@@ -113,4 +215,5 @@ if __name__ == "__main__":
         args.cookies_file,
         args.telegram_api,
         args.telegram_chatid,
+        args.save_credentials,
     )
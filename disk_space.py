@@ -0,0 +1,147 @@
+import logging
+import multiprocessing
+import os
+import shutil
+import threading
+from pathlib import Path
+
+from staging import get_staging_dir
+
+logger = logging.getLogger(__name__)
+
+# Запас свободного места по умолчанию, МБ
+DEFAULT_RESERVE_MB = 100
+
+
+def get_existing_path(path):
+    # Каталог загрузки может еще не существовать, проверяем ближайший существующий
+    path = Path(path).absolute()
+    while not path.exists() and path != path.parent:
+        path = path.parent
+    return path
+
+
+def get_free_space(path):
+    return shutil.disk_usage(get_existing_path(path)).free
+
+
+def get_device(path):
+    return os.stat(get_existing_path(path)).st_dev
+
+
+class SharedReservations:
+    """Резерв места для нескольких процессов загрузки (sharded_loader): у каждого
+    процесса своя ячейка общего массива, а общая блокировка делает проверку места
+    и резерв атомарными для всех процессов. Ячейку упавшего процесса родительский
+    процесс обнуляет перед перезапуском, чтобы его резерв не остался навсегда.
+    staged_slots - резерв в каталоге подготовки на другой файловой системе."""
+
+    def __init__(self, processes):
+        self.slots = multiprocessing.Array("q", processes, lock=False)
+        self.staged_slots = multiprocessing.Array("q", processes, lock=False)
+        self.lock = multiprocessing.Lock()
+
+    def reset(self, slot):
+        with self.lock:
+            self.slots[slot] = 0
+            self.staged_slots[slot] = 0
+
+
+class DiskSpace:
+    """Учет свободного места в каталоге загрузки.
+    Перед началом загрузки книги под нее резервируется место по размерам из
+    /files/grouped. Резерв уменьшается по мере записи файлов, поэтому уже записанные
+    байты не учитываются дважды. free_space_provider и device_provider можно
+    подменить для проверки. shared и slot - общий резерв процессов и ячейка этого
+    процесса в нем.
+    Если каталог подготовки (--staging-dir) на другой файловой системе, файлы
+    сначала занимают место там, а в каталоге загрузки появляются только при
+    переносе книги (commit_book). Поэтому место проверяется на обеих файловых
+    системах: запись файлов уменьшает резерв в каталоге подготовки, а резерв в
+    каталоге загрузки держится до release после переноса."""
+
+    def __init__(
+        self,
+        output,
+        reserve_bytes=DEFAULT_RESERVE_MB * 1024 * 1024,
+        free_space_provider=None,
+        shared=None,
+        slot=0,
+        device_provider=None,
+    ):
+        self.output = output
+        self.reserve_bytes = reserve_bytes
+        self.free_space_provider = free_space_provider or get_free_space
+        self.device_provider = device_provider or get_device
+        self.reserved = {}
+        self.staged = {}
+        self.shared = shared
+        self.slot = slot
+        self.lock = shared.lock if shared is not None else threading.Lock()
+
+    def get_reserved(self):
+        """Резерв в каталоге загрузки и в каталоге подготовки"""
+        if self.shared is not None:
+            return sum(self.shared.slots), sum(self.shared.staged_slots)
+        return sum(self.reserved.values()), sum(self.staged.values())
+
+    def get_separate_staging_dir(self):
+        """Каталог подготовки, если он на другой файловой системе, иначе пустая
+        строка: на той же файловой системе книга переносится переименованием и
+        место, занятое при записи, не меняется"""
+        staging_dir = get_staging_dir()
+        if staging_dir and self.device_provider(staging_dir) != self.device_provider(
+            self.output
+        ):
+            return staging_dir
+        return ""
+
+    def update_shared(self):
+        if self.shared is not None:
+            self.shared.slots[self.slot] = sum(self.reserved.values())
+            self.shared.staged_slots[self.slot] = sum(self.staged.values())
+
+    def has_space(self, book_id, path, size, reserved):
+        free = self.free_space_provider(path)
+        available = free - reserved - self.reserve_bytes
+        if size > available:
+            logger.warning(
+                f"Недостаточно места для книги {book_id} в {path}: требуется {size} "
+                f"байт, доступно {available} байт (свободно {free}, "
+                f"зарезервировано {reserved})"
+            )
+            return False
+        return True
+
+    def try_reserve(self, book_id, size, output_size=None):
+        """size - сколько байт будет записано, output_size - сколько из них
+        добавится в каталоге загрузки при переносе из каталога подготовки
+        (без файлов, которые там уже есть). По умолчанию равен size."""
+        with self.lock:
+            staging_dir = self.get_separate_staging_dir()
+            if not staging_dir or output_size is None:
+                output_size = size
+            reserved, staged = self.get_reserved()
+            if not self.has_space(book_id, self.output, output_size, reserved):
+                return False
+            if staging_dir and not self.has_space(book_id, staging_dir, size, staged):
+                return False
+            self.reserved[book_id] = self.reserved.get(book_id, 0) + output_size
+            if staging_dir:
+                self.staged[book_id] = self.staged.get(book_id, 0) + size
+            self.update_shared()
+            return True
+
+    def consume(self, book_id, size):
+        with self.lock:
+            reserved = self.staged if book_id in self.staged else self.reserved
+            if book_id in reserved:
+                reserved[book_id] = max(0, reserved[book_id] - size)
+                self.update_shared()
+
+    def release(self, book_id):
+        """Вызывается после переноса книги в каталог загрузки или при ошибке"""
+        with self.lock:
+            self.reserved.pop(book_id, None)
+            self.staged.pop(book_id, None)
+            self.update_shared()
@@ -1,5 +1,6 @@
 import requests
-from pathvalidate import sanitize_filename
+from functools import lru_cache
+from pathvalidate import sanitize_filename as pathvalidate_sanitize_filename
 import argparse
 import logging
 from pathlib import Path
@@ -7,20 +8,53 @@ from fake_useragent import UserAgent
 from tqdm import tqdm
 import shutil
 import re
-import sys
-import subprocess
-import json
-from requests.utils import cookiejar_from_dict
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
 
 from opf import book_info_to_xml, if_to_fi
-from common import LITRES_DOMAIN_NAME, cookies_is_valid
+from common import (
+    LITRES_DOMAIN_NAME,
+    LITRES_URL,
+    LITRES_WWW_URL,
+    LITRES_API_URL,
+    cookies_is_valid,
+    check_auth_error,
+    get_error_description,
+    AuthError,
+)
 from tg_sender import send_to_telegram, send_file_to_telegram
 from common_arguments import create_common_args, parse_args
-
+from profiler import profile_stage
+from throughput import add_transferred
+from progress import get_progress, start_progress
+from permissions import apply_file_permissions, apply_dir_permissions
+from disk_space import DiskSpace
+from cover_cache import fetch_cover
+from file_policy import select_files, get_extension
+from staging import (
+    WRITE_BUFFER_SIZE,
+    commit_book,
+    finish_file,
+    get_work_folder,
+)
+from cookie_pool import load_cookie_pool, download_with_pool
 
 logger = logging.getLogger(__name__)
+# Имена авторов и серий повторяются между книгами, а имя каждого файла проверяется
+# несколько раз (план, проверка загруженного, загрузка). pathvalidate каждый раз
+# заново разбирает имя, поэтому результат кешируется
+sanitize_filename = lru_cache(maxsize=4096)(pathvalidate_sanitize_filename)
 CLEANR = re.compile("<.*?>|&([a-z0-9]+|#[0-9]{1,6}|#x[0-9a-f]{1,6});")
-api_url = f"https://api.{LITRES_DOMAIN_NAME}/foundation/api/arts/"
+api_url = f"{LITRES_API_URL}/foundation/api/arts/"
+# Создание UserAgent каждый раз заново читает базу браузеров, поэтому создаем один раз
+user_agent = None
+# Размер ответа, начиная с которого JSON разбирается потоком
+STREAM_JSON_MIN_SIZE = 1024 * 1024
+# Размер блока при учете загруженных байт в общей сводке
+PROGRESS_CHUNK_SIZE = 64 * 1024
 
 
 def close_programm(msg, tg_api_key, tg_chat_id):
@@ -29,50 +63,81 @@ def close_programm(msg, tg_api_key, tg_chat_id):
 
 
 def get_headers():
-    ua = UserAgent()
-    agent = ua.firefox
+    global user_agent
+    if user_agent is None:
+        user_agent = UserAgent()
+    agent = user_agent.firefox
     return {
         "User-Agent": agent,
     }
 
 
 def download_content_file(url, path, filename, cookies, headers, progress_bar):
+    with profile_stage("file transfer"):
+        return _download_content_file(
+            url, path, filename, cookies, headers, progress_bar
+        )
+
+
+def _download_content_file(url, path, filename, cookies, headers, progress_bar):
     err_msg = ""
     logger.info(f"Загрузка файла: {url}")
     full_filename = Path(path) / sanitize_filename(filename)
 
     res = requests.get(url, stream=True, cookies=cookies, headers=headers)
+    progress = get_progress()
     if res.ok:
-        if progress_bar:
+        if progress is not None:
+            # Байты учитываются в общей сводке, индикатор на файл не нужен
+            total_size = int(res.headers.get("content-length", 0))
+            size = 0
+            with open(full_filename, "wb", buffering=WRITE_BUFFER_SIZE) as f:
+                for data in res.iter_content(PROGRESS_CHUNK_SIZE):
+                    f.write(data)
+                    size += len(data)
+                    progress.add_bytes(len(data))
+                finish_file(f)
+            if total_size != 0 and size != total_size:
+                err_msg = f"Не удалось загрузить файл: {url}"
+                logger.error(err_msg)
+                return err_msg
+        elif progress_bar:
             total_size = int(res.headers.get("content-length", 0))
             block_size = 1024
             with tqdm(
                 total=total_size, unit="B", unit_scale=True, desc=filename
             ) as progress_bar:
-                with open(full_filename, "wb") as file:
+                with open(full_filename, "wb", buffering=WRITE_BUFFER_SIZE) as file:
                     for data in res.iter_content(block_size):
                         progress_bar.update(len(data))
                         file.write(data)
+                    finish_file(file)
 
                 if total_size != 0 and progress_bar.n != total_size:
                     err_msg = f"Не удалось загрузить файл: {url}"
                     logger.error(err_msg)
                     return err_msg
         else:
-            with open(full_filename, "wb") as f:
-                shutil.copyfileobj(res.raw, f)
+            with open(full_filename, "wb", buffering=WRITE_BUFFER_SIZE) as f:
+                shutil.copyfileobj(res.raw, f, WRITE_BUFFER_SIZE)
+                finish_file(f)
     else:
-        err_descr = ""
-        try:
-            err_descr = f"({str(res.json())})"
-        except:
-            pass
-        err_msg = f"Ошибка: {res.status_code} {err_descr} файл: {url}"
+        err_msg = f"Ошибка: {res.status_code} {get_error_description(res)} файл: {url}"
         logger.error(err_msg)
+        check_auth_error(res.status_code, err_msg)
         return err_msg
+    add_transferred(full_filename.stat().st_size)
+    apply_file_permissions(full_filename)
     return err_msg
 
 
+def clean_html(text):
+    # Аннотация без разметки и сущностей не требует прохода регулярным выражением
+    if "<" not in text and "&" not in text:
+        return text
+    return CLEANR.sub("", text)
+
+
 def get_book_info(json_data):
     book_info = {
         "url": f'https://{LITRES_DOMAIN_NAME}{json_data["url"]}',
@@ -88,7 +153,7 @@ def get_book_info(json_data):
         "genres": [],
         "cover": json_data["cover_url"],
         "tags": [],
-        "description": re.sub(CLEANR, "", json_data["html_annotation"]),
+        "description": clean_html(json_data["html_annotation"]),
         "isbn": json_data["isbn"],
         "publishedYear": json_data["publication_date"].split("-")[0],
         "publishedDate": json_data["publication_date"],
@@ -126,41 +191,147 @@ def get_book_info(json_data):
     return book_info
 
 
-def get_book_folder(output, book_info):
-    book_folder = Path(output)
+def get_book_folder_path(output, book_info):
+    parts = []
     if book_info["author"] != "":
-        book_folder = Path(book_folder) / sanitize_filename(book_info["author"])
+        parts.append(sanitize_filename(book_info["author"]))
 
     if book_info["series"] != "":
-        book_folder = Path(book_folder) / sanitize_filename(book_info["series"])
+        parts.append(sanitize_filename(book_info["series"]))
 
     if book_info["series_num"] > 0:
-        book_folder = Path(book_folder) / sanitize_filename(
-            f'{book_info["series_num"]:02d} - {book_info["title"]} - читает {book_info["narrator"]}'
+        parts.append(
+            sanitize_filename(
+                f'{book_info["series_num"]:02d} - {book_info["title"]} - читает {book_info["narrator"]}'
+            )
         )
     else:
-        book_folder = Path(book_folder) / sanitize_filename(book_info["title"])
-    Path(book_folder).mkdir(exist_ok=True, parents=True)
+        parts.append(sanitize_filename(book_info["title"]))
+    return Path(output, *parts)
+
+
+def get_book_folder(output, book_info):
+    """Создает каталог, в который записываются файлы книги: каталог книги или,
+    если задан каталог подготовки (--staging-dir), соответствующий каталог в нем"""
+    book_folder = get_work_folder(output, get_book_folder_path(output, book_info))
+    for attempt in range(3):
+        try:
+            Path(book_folder).mkdir(exist_ok=True, parents=True)
+            break
+        except FileNotFoundError:
+            # Опустевший каталог автора или серии в каталоге подготовки мог быть
+            # удален одновременно после переноса другой книги (commit_book)
+            if attempt == 2:
+                raise
+    apply_dir_permissions(book_folder)
     return book_folder
 
 
+def is_book_file_complete(work_folder, book_folder, filename, size):
+    # Файл мог остаться в каталоге подготовки после прерванной загрузки
+    # или уже быть перенесен в каталог книги
+    return is_file_complete(work_folder, filename, size) or (
+        work_folder != book_folder and is_file_complete(book_folder, filename, size)
+    )
+
+
 def download_cover(book_folder, book_info):
     filename = Path(book_folder) / "cover.jpg"
-    url_string = f'https://{LITRES_DOMAIN_NAME}{book_info["cover"]}'
-    res = requests.get(url_string, stream=True)
-    if res.ok:
-        res.raw.decode_content = True
-        with open(filename, "wb") as f:
-            shutil.copyfileobj(res.raw, f)
-    else:
-        err_msg = f"Ошибка: {res.status_code} ({str(res.json())}) GET {url_string}"
-        logger.warning(err_msg)
+    url_string = f'{LITRES_URL}{book_info["cover"]}'
+    if fetch_cover(url_string, filename):
+        apply_file_permissions(filename)
 
 
 def create_metadata_file(book_folder, book_info):
     filename = Path(book_folder) / "metadata.opf"
     xml = book_info_to_xml(book_info)
     Path(filename).write_text(xml)
+    apply_file_permissions(filename)
+
+
+def read_groups_info(res):
+    # Большой ответ /files/grouped разбираем потоком (ijson), не держа в памяти
+    # весь документ. Небольшие ответы быстрее разобрать целиком. Без ijson
+    # (установка не по requirements.txt) ответ всегда разбирается целиком.
+    content_length = int(res.headers.get("content-length", STREAM_JSON_MIN_SIZE))
+    if ijson is not None and content_length >= STREAM_JSON_MIN_SIZE:
+        res.raw.decode_content = True
+        # use_float: дробные числа как float, а не Decimal, как и в res.json()
+        return ijson.items(res.raw, "payload.data.item", use_float=True)
+    return res.json()["payload"]["data"]
+
+
+def is_file_complete(path, filename, size):
+    # Файл, загруженный полностью при предыдущей попытке, повторно не загружаем
+    full_filename = Path(path) / sanitize_filename(filename)
+    return size > 0 and full_filename.is_file() and full_filename.stat().st_size == size
+
+
+def get_missing_sizes(work_folder, book_folder, files):
+    """Какие файлы книги уже загружены и сколько байт осталось: записать
+    (missing_size) и добавить в каталог загрузки при переносе из каталога
+    подготовки (output_size)"""
+    complete = [
+        is_book_file_complete(work_folder, book_folder, file[1], file[2])
+        for file in files
+    ]
+    missing_size = sum(file[2] for file, done in zip(files, complete) if not done)
+    output_size = sum(
+        file[2] for file in files if not is_file_complete(book_folder, file[1], file[2])
+    )
+    return complete, missing_size, output_size
+
+
+def get_files_to_download(book_id, groups_info):
+    """Список файлов книги к загрузке: (url, имя файла, размер, это fb2).
+    Какие группы и расширения загружать, задают правила file_policy (--files)"""
+    files = []
+    for file_info in select_files(groups_info):
+        file_id = file_info["id"]
+        filename = file_info["filename"]
+        if get_extension(file_info) == "fb2.zip":
+            # file_url = f"{LITRES_WWW_URL}/download_book_subscr/{book_id}/{file_id}/json"
+            file_url = (
+                f"{LITRES_WWW_URL}/download_book_subscr/{book_id}/{file_id}/fb2/zip"
+            )
+            files.append((file_url, filename, file_info.get("size", 0), True))
+        else:
+            file_url = (
+                f"{LITRES_WWW_URL}/download_book_subscr/{book_id}/{file_id}/{filename}"
+            )
+            files.append((file_url, filename, file_info.get("size", 0), False))
+    return files
+
+
+def get_book_metadata(book_id, cookies, headers, prefetch=False):
+    """Метаданные книги и список файлов к загрузке.
+    Возвращает (book_info, files, код ответа, текст ошибки или пустая строка).
+    prefetch=True - запрос из фонового потока предзагрузки: он идет одновременно
+    с загрузкой файлов, поэтому в профиле это отдельные одновременные этапы"""
+    stage_prefix = "prefetch " if prefetch else ""
+    url_string = api_url + book_id
+    with profile_stage(stage_prefix + "arts metadata", concurrent=prefetch):
+        res = requests.get(url_string, cookies=cookies, headers=headers)
+        if res.ok:
+            book_info = get_book_info(res.json()["payload"]["data"])
+    if not res.ok:
+        err_msg = (
+            f"Ошибка: {res.status_code} {get_error_description(res)} GET {url_string}"
+        )
+        return None, None, res.status_code, err_msg
+
+    url_string = url_string + "/files/grouped"
+    with profile_stage(stage_prefix + "grouped listing", concurrent=prefetch):
+        res = requests.get(url_string, cookies=cookies, headers=headers, stream=True)
+        if res.ok:
+            files = get_files_to_download(book_id, read_groups_info(res))
+    if not res.ok:
+        err_msg = (
+            f"Ошибка: {res.status_code} {get_error_description(res)} GET {url_string}"
+        )
+        return None, None, res.status_code, err_msg
+    res.close()
+    return book_info, files, res.status_code, ""
 
 
 def download_book(
@@ -173,82 +344,95 @@ def download_book(
     load_cover,
     create_metadata,
     send_fb2_via_telegram,
+    disk_space=None,
+    prefetched=None,
 ):
+    """Возвращает False, если книга отложена из-за нехватки места на диске.
+    prefetched - результат get_book_metadata, заранее полученный при предзагрузке"""
     headers = get_headers()
     book_id = url.split("-")[-1].split("/")[0]
 
-    url_string = api_url + book_id
-    res = requests.get(url_string, cookies=cookies, headers=headers)
-    if not res.ok:
-        err_msg = f"Ошибка: {res.status_code} ({str(res.json())}) GET {url_string}"
-        logger.error(err_msg)
-        close_programm(err_msg, tg_api_key, tg_chat_id)
-
-    book_info = get_book_info(res.json()["payload"]["data"])
-    msg = f"Начало загрузки книги:\n{book_info['title']}\nавтор: {book_info['author']}"
-    logger.debug(msg)
-    send_to_telegram(msg, tg_api_key, tg_chat_id)
-
-    book_folder = get_book_folder(output, book_info)
-    logger.info(f"Загрузка файлов в каталог: {book_folder}")
-
-    # Загрузка обложки
-    if load_cover:
-        download_cover(book_folder, book_info)
-    # Формирование файла метаданных
-    if create_metadata:
-        create_metadata_file(book_folder, book_info)
-
-    # Список файлов для загрузки
-    url_string = url_string + "/files/grouped"
-    res = requests.get(url_string, cookies=cookies, headers=headers)
-    if not res.ok:
-        err_msg = f"Ошибка: {res.status_code} ({str(res.json())}) GET {url_string}"
+    if prefetched is None:
+        prefetched = get_book_metadata(book_id, cookies, headers)
+    book_info, files, status_code, err_msg = prefetched
+    if err_msg != "":
         logger.error(err_msg)
+        check_auth_error(status_code, err_msg)
         close_programm(err_msg, tg_api_key, tg_chat_id)
 
-    groups_info = res.json()["payload"]["data"]
-    for group_info in groups_info:
-        # Загрузка mp3
-        if "standard_quality_mp3" in group_info["file_type"]:
-            files_info = group_info["files"]
-            for file_info in files_info:
-                file_id = file_info["id"]
-                filename = file_info["filename"]
-                file_url = f"https://www.{LITRES_DOMAIN_NAME}/download_book_subscr/{book_id}/{file_id}/{filename}"
+    # Проверим, что книга поместится на диск, до создания каталога и файлов.
+    # Файлы, загруженные при прошлом запуске, места не требуют
+    if disk_space is None:
+        disk_space = DiskSpace(output)
+    book_folder = get_book_folder_path(output, book_info)
+    work_folder = get_work_folder(output, book_folder)
+    complete, missing_size, output_size = get_missing_sizes(
+        work_folder, book_folder, files
+    )
+    book_size = sum(file[2] for file in files)
+    if not disk_space.try_reserve(book_id, missing_size, output_size):
+        return False
+
+    progress = get_progress()
+    if progress is not None:
+        progress.start_book(url, book_info["title"], book_size, len(files))
+    try:
+        msg = f"Начало загрузки книги:\n{book_info['title']}\nавтор: {book_info['author']}"
+        logger.debug(msg)
+        send_to_telegram(msg, tg_api_key, tg_chat_id)
+
+        with profile_stage("folder creation"):
+            get_book_folder(output, book_info)
+        logger.info(f"Загрузка файлов в каталог: {work_folder}")
+
+        # Загрузка обложки
+        if load_cover:
+            with profile_stage("cover"):
+                download_cover(work_folder, book_info)
+        # Формирование файла метаданных
+        if create_metadata:
+            with profile_stage("opf"):
+                create_metadata_file(work_folder, book_info)
+
+        for num, (file_url, filename, file_size, is_fb2) in enumerate(files, 1):
+            if complete[num - 1]:
+                logger.info(f"Файл уже загружен: {filename}")
+                if progress is not None:
+                    progress.skip_bytes(file_size)
+            else:
                 err_msg = download_content_file(
-                    file_url, book_folder, filename, cookies, headers, progress_bar
+                    file_url, work_folder, filename, cookies, headers, progress_bar
                 )
                 if err_msg != "":
                     close_programm(err_msg, tg_api_key, tg_chat_id)
-        elif "unknown" in group_info["file_type"] and type(group_info["files"]) == type(
-            []
-        ):
-            for file_spec in group_info["files"]:
-                if file_spec["extension"] == "fb2.zip":
-                    file_id = file_spec["id"]
-                    filename = file_spec["filename"]
-                    # file_url = f"https://www.{LITRES_DOMAIN_NAME}/download_book_subscr/{book_id}/{file_id}/json"
-                    file_url = f"https://www.{LITRES_DOMAIN_NAME}/download_book_subscr/{book_id}/{file_id}/fb2/zip"
-                    err_msg = download_content_file(
-                        file_url, book_folder, filename, cookies, headers, progress_bar
-                    )
-                    if err_msg != "":
-                        close_programm(err_msg, tg_api_key, tg_chat_id)
-                    # Файл загружен без ошибки, попробуем отправить его в телеграм
-                    if send_fb2_via_telegram and tg_api_key != "" and tg_chat_id != "":
-                        full_filename = Path(book_folder) / filename
-                        send_file_to_telegram(full_filename, tg_api_key, tg_chat_id)
-                        # Если отправили файл в телеграм, нет смысла дополнительно
-                        # сообщать об успешной загрузке. Выходим из программы.
-                        exit(0)
+                disk_space.consume(book_id, file_size)
+            if progress is not None:
+                progress.update_book(url, book_info["title"], num, len(files))
+            # Файл загружен без ошибки, попробуем отправить его в телеграм
+            if (
+                is_fb2
+                and send_fb2_via_telegram
+                and tg_api_key != ""
+                and tg_chat_id != ""
+            ):
+                commit_book(work_folder, book_folder)
+                full_filename = Path(book_folder) / filename
+                send_file_to_telegram(full_filename, tg_api_key, tg_chat_id)
+                # Если отправили файл в телеграм, нет смысла дополнительно
+                # сообщать об успешной загрузке. Выходим из программы.
+                exit(0)
+        commit_book(work_folder, book_folder)
+    finally:
+        disk_space.release(book_id)
+    if progress is not None:
+        progress.finish_book(url)
+
     msg = (
         f"Окончание загрузки книги:\n{book_info['title']}\nавтор: {book_info['author']}"
     )
     logger.debug(msg)
     send_to_telegram(msg, tg_api_key, tg_chat_id)
-    if sys.platform != "win32":
-        subprocess.Popen(f"chmod -R ugo+wrX '{str(book_folder)}'", shell=True)
+    return True
 
 
 if __name__ == "__main__":
@@ -270,7 +454,7 @@ if __name__ == "__main__":
     )
     parser.add_argument(
         "--progressbar",
-        help="Показывать прогресс для каждого файла",
+        help="Показывать общий ход загрузки: объем, скорость, оставшееся время и загружаемые файлы",
         action=argparse.BooleanOptionalAction,
         default=False,
     )
@@ -278,37 +462,63 @@ if __name__ == "__main__":
         "--cookies-file",
         help=(
             "Файл содержащий cookies. Нужно предварительно сформировать скриптом create-cookies.py "
-            "или извлечь из браузера скриптом get_browser_cookies.py"
+            "или извлечь из браузера скриптом get_browser_cookies.py. "
+            "Можно указать несколько файлов разных аккаунтов: при ошибке авторизации "
+            "загрузка продолжится со следующими. "
             "По умолчанию: cookies.json в каталоге скрипта"
         ),
-        default="cookies.json",
+        nargs="+",
+        default=["cookies.json"],
     )
 
     args = parse_args(parser, logger)
     logger.info(args)
 
-    if Path(args.cookies_file).is_file():
-        logger.info(f"Попытка извлечь cookies из файла {args.cookies_file}")
-        cookies_dict = json.loads(Path(args.cookies_file).read_text())
-        cookies = cookiejar_from_dict(cookies_dict)
-
-        # Проверим, что куки из файла валидные, иначе прервем выполнение
-        err_msg = cookies_is_valid(cookies, args.telegram_api, args.telegram_chatid)
-        if not err_msg == "":
-            close_programm(err_msg, args.telegram_api, args.telegram_chatid)
-    else:
-        err_msg = f"Не найден файл с cookies: {args.cookies_file}"
+    # Проверим, что куки из файлов валидные, иначе прервем выполнение
+    cookie_pool = load_cookie_pool(
+        args.cookies_file, args.telegram_api, args.telegram_chatid
+    )
+    if len(cookie_pool) == 0:
+        err_msg = f"Не найдены действующие cookies в файлах: {args.cookies_file}"
         logger.error(err_msg)
         close_programm(err_msg, args.telegram_api, args.telegram_chatid)
 
-    download_book(
-        args.url,
-        args.output,
-        cookies,
-        args.telegram_api,
-        args.telegram_chatid,
-        args.progressbar,
-        args.cover,
-        args.metadata,
-        args.send_fb2_via_telegram,
+    disk_space = DiskSpace(args.output, args.reserve_space * 1024 * 1024)
+    kwargs = {}
+    if args.engine == "aiohttp":
+        import async_engine
+
+        download = async_engine.download_book
+        kwargs["max_transfers"] = args.max_transfers
+    else:
+        download = download_book
+    progress = start_progress(
+        1, args.progressbar, args.status_file, args.progress_refresh
     )
+    state = "stopped"
+    try:
+        downloaded = download_with_pool(
+            cookie_pool,
+            download,
+            args.url,
+            args.output,
+            args.telegram_api,
+            args.telegram_chatid,
+            args.progressbar,
+            args.cover,
+            args.metadata,
+            args.send_fb2_via_telegram,
+            disk_space,
+            **kwargs,
+        )
+        if downloaded:
+            state = "finished"
+    except AuthError as e:
+        close_programm(str(e), args.telegram_api, args.telegram_chatid)
+    finally:
+        if progress is not None:
+            progress.stop(state)
+    if not downloaded:
+        err_msg = f"Недостаточно места в каталоге {args.output} для загрузки книги: {args.url}"
+        logger.error(err_msg)
+        close_programm(err_msg, args.telegram_api, args.telegram_chatid)
@@ -0,0 +1,121 @@
+import argparse
+import json
+import logging
+from fnmatch import fnmatch
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+AUDIO_EXTENSIONS = ["mp3", "mp4", "m4a", "m4b"]
+ALL = "all"
+LARGEST = "largest"
+SMALLEST = "smallest"
+
+# Правило выбирает группы ответа /files/grouped, file_type которых подходит под
+# шаблон group, и файлы групп с расширениями из extensions (шаблоны, по умолчанию
+# любые). pick задает, сколько подходящих групп загружать: all - все, largest или
+# smallest - одну группу с наибольшим или наименьшим общим размером.
+# Группа обрабатывается первым подходящим правилом.
+PRESETS = {
+    # Прежнее поведение: mp3 стандартного качества и fb2
+    "default": [
+        {"group": "*standard_quality_mp3*"},
+        {"group": "*unknown*", "extensions": ["fb2.zip"]},
+    ],
+    "audio": [{"group": "*standard_quality_mp3*"}],
+    "text": [{"group": "*unknown*", "extensions": ["fb2.zip"]}],
+    # Аудио наименьшего размера, например для мобильных устройств
+    "mobile": [{"group": "*", "extensions": AUDIO_EXTENSIONS, "pick": SMALLEST}],
+    "largest": [{"group": "*", "extensions": AUDIO_EXTENSIONS, "pick": LARGEST}],
+    "all": [{"group": "*"}],
+}
+DEFAULT_POLICY = "default"
+
+_rules = PRESETS[DEFAULT_POLICY]
+
+
+def check_rules(rules):
+    if not isinstance(rules, list) or len(rules) == 0:
+        raise ValueError("ожидается непустой список правил")
+    for rule in rules:
+        if not isinstance(rule, dict) or not isinstance(rule.get("group"), str):
+            raise ValueError(f"в правиле {rule} не задан шаблон group")
+        extensions = rule.get("extensions", ["*"])
+        if not isinstance(extensions, list) or not all(
+            isinstance(extension, str) for extension in extensions
+        ):
+            raise ValueError(f"в правиле {rule} extensions должен быть списком строк")
+        if rule.get("pick", ALL) not in [ALL, LARGEST, SMALLEST]:
+            raise ValueError(
+                f"в правиле {rule} pick должен быть одним из: {ALL}, {LARGEST}, {SMALLEST}"
+            )
+    return rules
+
+
+def file_policy_arg(value):
+    """Тип аргумента --files: имя набора правил из PRESETS или json файл с правилами"""
+    if value in PRESETS:
+        return PRESETS[value]
+    try:
+        data = json.loads(Path(value).read_text())
+        # В файле можно задать как список правил, так и {"rules": [...]}
+        if isinstance(data, dict):
+            data = data.get("rules")
+        return check_rules(data)
+    except (OSError, ValueError) as e:
+        raise argparse.ArgumentTypeError(
+            f"{value} - не набор правил ({', '.join(PRESETS)}) и не файл правил: {e}"
+        )
+
+
+def set_file_policy(rules):
+    global _rules
+    _rules = check_rules(rules)
+    logger.debug(f"Правила выбора файлов: {_rules}")
+
+
+def get_file_policy():
+    return _rules
+
+
+def get_extension(file_info):
+    extension = file_info.get("extension") or Path(file_info["filename"]).suffix[1:]
+    return extension.lower()
+
+
+def select_files(groups_info, rules=None):
+    """Файлы групп /files/grouped, выбранные правилами, в порядке групп ответа"""
+    if rules is None:
+        rules = _rules
+    # Кандидаты по правилам: [(номер группы, файлы группы)]
+    candidates = [[] for rule in rules]
+    for num, group_info in enumerate(groups_info):
+        group_files = group_info.get("files")
+        if not isinstance(group_files, list):
+            continue
+        for rule_num, rule in enumerate(rules):
+            if fnmatch(group_info.get("file_type", ""), rule["group"]):
+                extensions = rule.get("extensions", ["*"])
+                files = [
+                    file_info
+                    for file_info in group_files
+                    if any(
+                        fnmatch(get_extension(file_info), extension)
+                        for extension in extensions
+                    )
+                ]
+                if len(files) > 0:
+                    candidates[rule_num].append((num, files))
+                break
+
+    selected = []
+    for rule, groups in zip(rules, candidates):
+        pick = rule.get("pick", ALL)
+        if pick != ALL and len(groups) > 1:
+            size = lambda group: sum(f.get("size", 0) for f in group[1])
+            groups = [
+                max(groups, key=size) if pick == LARGEST else min(groups, key=size)
+            ]
+        selected.extend(groups)
+    selected.sort(key=lambda group: group[0])
+    return [file_info for num, files in selected for file_info in files]
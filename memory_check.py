@@ -0,0 +1,117 @@
+import argparse
+import json
+import logging
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+BENCHMARK = Path(__file__).parent / "benchmark.py"
+# Допустимый рост пикового размера памяти на длинной очереди, МБ
+DEFAULT_MAX_GROWTH_MB = 10
+
+
+def measure_rss(lines, mode, engine, processes, timeout):
+    """Пиковый размер памяти загрузчика на синтетической очереди из lines книг.
+    Каждый замер выполняется в отдельном процессе benchmark.py, чтобы ru_maxrss
+    относился только к этой очереди. Книги минимальные (один файл 1 КБ без
+    обложки и метаданных), чтобы замер определялся длиной очереди."""
+    with tempfile.TemporaryDirectory() as workdir:
+        report_file = Path(workdir) / "report.json"
+        command = [
+            sys.executable,
+            str(BENCHMARK),
+            "--mode",
+            mode,
+            "--engine",
+            engine,
+            "--processes",
+            str(processes),
+            "--books",
+            str(lines),
+            "--files-per-book",
+            "1",
+            "--file-size",
+            "1024",
+            "--no-cover",
+            "--no-metadata",
+            "--no-telegram",
+            "-o",
+            str(Path(workdir) / "output"),
+            "--report",
+            str(report_file),
+        ]
+        logger.info(" ".join(command))
+        subprocess.run(command, check=True, timeout=timeout, stdout=subprocess.DEVNULL)
+        report = json.loads(report_file.read_text())
+    if report["books_done"] != lines:
+        raise RuntimeError(f"Загружено книг {report['books_done']} из {lines}")
+    # В режиме sharded книги загружают дочерние процессы: берем больший из
+    # родительского процесса и наибольшего дочернего
+    return max(report["max_rss_mb"], report.get("max_rss_workers_mb", 0))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        level=logging.INFO,
+    )
+    parser = argparse.ArgumentParser(
+        description=(
+            "Проверка, что пиковый размер памяти загрузчика не растет с длиной "
+            "очереди: синтетические очереди из --small-lines и --lines книг "
+            "загружаются с локального тестового сервера benchmark.py"
+        )
+    )
+    parser.add_argument(
+        "--lines", help="Длина длинной очереди", type=int, default=100000
+    )
+    parser.add_argument(
+        "--small-lines", help="Длина короткой очереди", type=int, default=100
+    )
+    parser.add_argument(
+        "--mode",
+        help="Что проверять: multiloader.download_books или sharded_loader.download_books_sharded",
+        choices=["multiloader", "sharded"],
+        default="multiloader",
+    )
+    parser.add_argument(
+        "--engine",
+        help="Способ загрузки: requests или aiohttp",
+        choices=["requests", "aiohttp"],
+        default="requests",
+    )
+    parser.add_argument(
+        "--processes", help="Число процессов для --mode sharded", type=int, default=4
+    )
+    parser.add_argument(
+        "--max-growth",
+        help="Допустимый рост пикового размера памяти на длинной очереди, МБ",
+        type=float,
+        default=DEFAULT_MAX_GROWTH_MB,
+    )
+    parser.add_argument(
+        "--timeout",
+        help="Ограничение времени одного замера, секунд",
+        type=int,
+        default=3 * 60 * 60,
+    )
+    args = parser.parse_args()
+
+    results = {}
+    for lines in [args.small_lines, args.lines]:
+        results[lines] = measure_rss(
+            lines, args.mode, args.engine, args.processes, args.timeout
+        )
+        print(f"Очередь {lines} книг: пиковый размер памяти {results[lines]} МБ")
+
+    growth = results[args.lines] - results[args.small_lines]
+    print(f"Рост: {growth:.1f} МБ (допустимо {args.max_growth} МБ)")
+    if growth > args.max_growth:
+        logger.error(
+            f"Пиковый размер памяти растет с длиной очереди: {results[args.small_lines]} МБ "
+            f"для {args.small_lines} книг, {results[args.lines]} МБ для {args.lines} книг"
+        )
+        exit(1)
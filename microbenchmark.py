@@ -0,0 +1,161 @@
+import argparse
+import json
+import logging
+import re
+import timeit
+from pathlib import Path
+
+from download_book import (
+    CLEANR,
+    get_book_folder_path,
+    get_book_info,
+    sanitize_filename,
+)
+from opf import if_to_fi
+
+logger = logging.getLogger(__name__)
+
+FIXTURES_DIR = Path(__file__).parent / "fixtures"
+# Размер аннотации для проверки на огромных описаниях, байт
+DEFAULT_HUGE_SIZE = 1024 * 1024
+# Число файлов книги для замера sanitize_filename
+FILES_PER_BOOK = 50
+
+
+def load_fixtures(fixtures_dir, huge_size):
+    """Записанные ответы /arts/{id}. Для каждого дополнительно создается вариант
+    с аннотацией размером не меньше huge_size"""
+    fixtures = {}
+    for filename in sorted(Path(fixtures_dir).glob("arts_*.json")):
+        data = json.loads(filename.read_text())["payload"]["data"]
+        fixtures[filename.stem] = data
+        if huge_size > 0:
+            annotation = data["html_annotation"]
+            repeat = huge_size // max(1, len(annotation.encode())) + 1
+            fixtures[f"{filename.stem}_huge"] = dict(
+                data, html_annotation="\n".join([annotation] * repeat)
+            )
+    return fixtures
+
+
+def measure(func, repeat=3):
+    """Время одного вызова func в микросекундах (лучшее из repeat замеров)"""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number * 1e6
+
+
+def clear_caches():
+    sanitize_filename.cache_clear()
+    if_to_fi.cache_clear()
+
+
+def get_file_names(book_info):
+    return [f"{book_info['title']} {num:03d}.mp3" for num in range(FILES_PER_BOOK)]
+
+
+def run_microbenchmarks(fixtures):
+    """Замеры для каждого образца. Варианты cold - с очисткой кешей перед каждым
+    вызовом (первая встреча имени), warm - повторные имена из кеша, uncached -
+    прежняя реализация без кеша для сравнения"""
+    results = {}
+    for name, data in fixtures.items():
+        book_info = get_book_info(data)
+        persons = [person["full_name"] for person in data["persons"]]
+        filenames = get_file_names(book_info)
+
+        def cold(func):
+            def run():
+                clear_caches()
+                func()
+
+            return run
+
+        benchmarks = {
+            "get_book_info": lambda: get_book_info(data),
+            "get_book_info.cold": cold(lambda: get_book_info(data)),
+            "clean_html.uncached": lambda: re.sub(CLEANR, "", data["html_annotation"]),
+            "get_book_folder": lambda: get_book_folder_path(".", book_info),
+            "get_book_folder.cold": cold(lambda: get_book_folder_path(".", book_info)),
+            "if_to_fi": lambda: [if_to_fi(person) for person in persons],
+            "if_to_fi.uncached": lambda: [
+                if_to_fi.__wrapped__(person) for person in persons
+            ],
+            "sanitize_filename": lambda: [
+                sanitize_filename(filename) for filename in filenames
+            ],
+            "sanitize_filename.cold": cold(
+                lambda: [sanitize_filename(filename) for filename in filenames]
+            ),
+            "sanitize_filename.uncached": lambda: [
+                sanitize_filename.__wrapped__(filename) for filename in filenames
+            ],
+        }
+        for bench_name, func in benchmarks.items():
+            func()
+            results[f"{name}/{bench_name}"] = round(measure(func), 3)
+            logger.info(f"{name}/{bench_name}: {results[f'{name}/{bench_name}']} мкс")
+    return results
+
+
+def check_regression(results, baseline, max_regression):
+    err_msgs = []
+    for key, value in results.items():
+        if baseline.get(key, 0) > 0:
+            change = (value - baseline[key]) / baseline[key] * 100
+            if change > max_regression:
+                err_msgs.append(
+                    f"{key}: {value} мкс, было {baseline[key]} мкс (+{change:.1f}%)"
+                )
+    return err_msgs
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        level=logging.ERROR,
+    )
+    parser = argparse.ArgumentParser(
+        description=(
+            "Замер времени функций, выполняемых для каждой книги и файла "
+            "(get_book_info, get_book_folder, if_to_fi, sanitize_filename), "
+            "на записанных ответах /arts/{id}"
+        )
+    )
+    parser.add_argument(
+        "--fixtures",
+        help=f"Каталог с образцами arts_*.json. По умолчанию: {FIXTURES_DIR}",
+        default=str(FIXTURES_DIR),
+    )
+    parser.add_argument(
+        "--huge-size",
+        help="Размер аннотации для замера на огромных описаниях, байт. 0 - без этих замеров",
+        type=int,
+        default=DEFAULT_HUGE_SIZE,
+    )
+    parser.add_argument("--report", help="Сохранить результаты в json файл", default="")
+    parser.add_argument(
+        "--baseline", help="json файл с результатами предыдущего замера", default=""
+    )
+    parser.add_argument(
+        "--max-regression",
+        help="Допустимое увеличение времени относительно --baseline в процентах",
+        type=float,
+        default=20,
+    )
+    args = parser.parse_args()
+
+    results = run_microbenchmarks(load_fixtures(args.fixtures, args.huge_size))
+    width = max(len(key) for key in results)
+    for key, value in results.items():
+        print(f"{key:<{width}} {value:>12.3f} мкс")
+    if args.report:
+        Path(args.report).write_text(json.dumps(results, indent=2))
+
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text())
+        err_msgs = check_regression(results, baseline, args.max_regression)
+        for err_msg in err_msgs:
+            logger.error(err_msg)
+        if len(err_msgs) > 0:
+            exit(1)
@@ -1,15 +1,27 @@
 import argparse
 import logging
-from pathlib import Path
 from download_book import (
     download_book,
-    cookies_is_valid,
+    send_to_telegram,
     close_programm,
     LITRES_DOMAIN_NAME,
 )
-import json
-from requests.utils import cookiejar_from_dict
+import tempfile
+import time
+from collections import deque
+from common import AuthError
 from common_arguments import create_common_args_without_url, parse_args
+from disk_space import DiskSpace
+from prefetch import Prefetcher, DEFAULT_PREFETCH
+from throughput import DEFAULT_STATS_FILE, record_run
+from progress import start_progress, count_queue
+from cookie_pool import (
+    ROUND_ROBIN,
+    LEAST_LOAD,
+    as_cookie_pool,
+    load_cookie_pool,
+    download_with_pool,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -23,22 +35,81 @@ def download_books(
     progressbar,
     load_cover,
     create_metadata,
+    disk_space=None,
+    prefetch=DEFAULT_PREFETCH,
 ):
-    with open(input, "r") as f:
-        for url in f:
-            url_trim = url.strip()
-            if "litres.ru" in url_trim:
-                logger.info(f"Адрес к загрузке: {url_trim}")
-                download_book(
-                    url_trim,
-                    output,
-                    cookies,
-                    tg_api_key,
-                    tg_chat_id,
-                    progressbar,
-                    load_cover,
-                    create_metadata,
-                )
+    """prefetch - число следующих книг очереди, метаданные и обложки которых
+    загружаются в фоне, пока идет загрузка текущей книги. 0 - без предзагрузки"""
+    if disk_space is None:
+        disk_space = DiskSpace(output)
+    cookie_pool = as_cookie_pool(cookies)
+    prefetcher = Prefetcher(cookie_pool, prefetch, load_cover) if prefetch > 0 else None
+
+    def load(url, prefetched=None):
+        try:
+            return download_with_pool(
+                cookie_pool,
+                download_book,
+                url,
+                output,
+                tg_api_key,
+                tg_chat_id,
+                progressbar,
+                load_cover,
+                create_metadata,
+                False,
+                disk_space,
+                prefetched=prefetched,
+            )
+        except AuthError as e:
+            close_programm(str(e), tg_api_key, tg_chat_id)
+
+    # Книги, которым не хватило места, откладываются до конца очереди.
+    # Отложенные адреса пишутся во временный файл, чтобы память не росла с очередью.
+    deferred = tempfile.TemporaryFile("w+")
+
+    def load_queued(url):
+        prefetched = prefetcher.pop(url) if prefetcher is not None else None
+        logger.info(f"Адрес к загрузке: {url}")
+        if not load(url, prefetched):
+            logger.warning(f"Загрузка отложена: {url}")
+            deferred.write(url + "\n")
+
+    # Окно из prefetch следующих адресов очереди, для которых идет предзагрузка
+    window = deque()
+    try:
+        with open(input, "r") as f:
+            for url in f:
+                url_trim = url.strip()
+                if "litres.ru" in url_trim:
+                    if prefetcher is not None:
+                        prefetcher.submit(url_trim)
+                    window.append(url_trim)
+                    if len(window) > prefetch:
+                        load_queued(window.popleft())
+        while len(window) > 0:
+            load_queued(window.popleft())
+    finally:
+        if prefetcher is not None:
+            prefetcher.close()
+
+    not_loaded = []
+    deferred.seek(0)
+    for url in deferred:
+        url = url.strip()
+        logger.info(f"Повторная попытка загрузки: {url}")
+        if not load(url):
+            not_loaded.append(url)
+    deferred.close()
+
+    if len(not_loaded) > 0:
+        err_msg = (
+            f"Недостаточно места в каталоге {output}. Не загружены книги:\n"
+            + "\n".join(not_loaded)
+        )
+        logger.error(err_msg)
+        send_to_telegram(err_msg, tg_api_key, tg_chat_id)
+    return not_loaded
 
 
 if __name__ == "__main__":
@@ -54,15 +125,72 @@ if __name__ == "__main__":
     # Добавляем специфические аргументы для данной качалки
     parser.add_argument(
         "--progressbar",
-        help="Показывать прогресс для каждого файла",
+        help="Показывать общий ход загрузки: книги, объем, скорость, оставшееся время и книги в работе",
         action=argparse.BooleanOptionalAction,
         default=False,
     )
     parser.add_argument(
         "--cookies-file",
         help="Файл содержащий cookies. Нужно предварительно сформировать скриптом create-cookies.py \
+            Можно указать несколько файлов разных аккаунтов: задания распределяются между ними, \
+            а cookies с ошибкой авторизации исключаются из работы. \
             По умолчанию: cookies.json в каталоге скрипта",
-        default="cookies.json",
+        nargs="+",
+        default=["cookies.json"],
+    )
+    parser.add_argument(
+        "--cookies-strategy",
+        help="Распределение книг между несколькими файлами cookies: по кругу или на наименее загруженный. \
+            По умолчанию: round-robin",
+        choices=[ROUND_ROBIN, LEAST_LOAD],
+        default=ROUND_ROBIN,
+    )
+    parser.add_argument(
+        "--max-books",
+        help="Максимальное число одновременно загружаемых книг для --engine aiohttp. По умолчанию: 4",
+        type=int,
+        default=4,
+    )
+    parser.add_argument(
+        "--prefetch",
+        help=(
+            "Сколько следующих книг очереди предзагружать (метаданные и обложки), "
+            f"пока загружаются файлы текущей книги. 0 - без предзагрузки. По умолчанию: {DEFAULT_PREFETCH}"
+        ),
+        type=int,
+        default=DEFAULT_PREFETCH,
+    )
+    parser.add_argument(
+        "--processes",
+        help=(
+            "Число процессов загрузки. Очередь делится между процессами по авторам, "
+            "упавший процесс перезапускается и продолжает свою часть очереди. По умолчанию: 1"
+        ),
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--plan",
+        help=(
+            "Ничего не загружать, а вывести план: размеры книг очереди, число файлов, "
+            "уже загруженные книги и оценку времени загрузки"
+        ),
+        action=argparse.BooleanOptionalAction,
+        default=False,
+    )
+    parser.add_argument(
+        "--plan-concurrency",
+        help="Число одновременных запросов метаданных для --plan. По умолчанию: 8",
+        type=int,
+        default=8,
+    )
+    parser.add_argument(
+        "--stats-file",
+        help=(
+            "Файл статистики скорости загрузки, по которой --plan оценивает время. "
+            f"По умолчанию: {DEFAULT_STATS_FILE}"
+        ),
+        default=str(DEFAULT_STATS_FILE),
     )
     parser.add_argument(
         "-i",
@@ -74,27 +202,91 @@ if __name__ == "__main__":
     args = parse_args(parser, logger, check_url=False)
     logger.info(args)
 
-    if Path(args.cookies_file).is_file():
-        logger.info(f"Попытка извлечь cookies из файла {args.cookies_file}")
-        cookies_dict = json.loads(Path(args.cookies_file).read_text())
-        cookies = cookiejar_from_dict(cookies_dict)
-
-        # Проверим, что куки из файла валидные, иначе прервем выполнение
-        err_msg = cookies_is_valid(cookies, args.telegram_api, args.telegram_chatid)
-        if not err_msg == "":
-            close_programm(err_msg, args.telegram_api, args.telegram_chatid)
-    else:
-        err_msg = f"Не найден файл с cookies: {args.cookies_file}"
+    # Проверим, что куки из файлов валидные, иначе прервем выполнение
+    cookies = load_cookie_pool(
+        args.cookies_file,
+        args.telegram_api,
+        args.telegram_chatid,
+        args.cookies_strategy,
+    )
+    if len(cookies) == 0:
+        err_msg = f"Не найдены действующие cookies в файлах: {args.cookies_file}"
         logger.error(err_msg)
         close_programm(err_msg, args.telegram_api, args.telegram_chatid)
 
-    download_books(
-        args.input,
-        args.output,
-        cookies,
-        args.telegram_api,
-        args.telegram_chatid,
+    if args.plan:
+        from plan import print_plan
+
+        print_plan(
+            args.input,
+            args.output,
+            cookies,
+            args.plan_concurrency,
+            args.stats_file,
+        )
+        exit(0)
+
+    started = time.perf_counter()
+    disk_space = DiskSpace(args.output, args.reserve_space * 1024 * 1024)
+    progress = start_progress(
+        count_queue(args.input),
         args.progressbar,
-        args.cover,
-        args.metadata,
+        args.status_file,
+        args.progress_refresh,
     )
+    state = "stopped"
+    try:
+        if args.processes > 1:
+            from sharded_loader import download_books_sharded
+
+            download_books_sharded(
+                args.input,
+                args.output,
+                cookies,
+                args.telegram_api,
+                args.telegram_chatid,
+                args.progressbar,
+                args.cover,
+                args.metadata,
+                args.processes,
+                args.engine,
+                args.reserve_space * 1024 * 1024,
+                (args.file_mode, args.dir_mode, args.umask),
+                (args.cover_cache, args.cover_cache_size * 1024 * 1024),
+                args.files,
+                (args.staging_dir, args.fsync),
+            )
+        elif args.engine == "aiohttp":
+            import async_engine
+
+            async_engine.download_books(
+                args.input,
+                args.output,
+                cookies,
+                args.telegram_api,
+                args.telegram_chatid,
+                args.progressbar,
+                args.cover,
+                args.metadata,
+                disk_space,
+                args.max_books,
+                args.max_transfers,
+            )
+        else:
+            download_books(
+                args.input,
+                args.output,
+                cookies,
+                args.telegram_api,
+                args.telegram_chatid,
+                args.progressbar,
+                args.cover,
+                args.metadata,
+                disk_space,
+                args.prefetch,
+            )
+        state = "finished"
+    finally:
+        if progress is not None:
+            progress.stop(state)
+    record_run(time.perf_counter() - started, args.stats_file)
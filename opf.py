@@ -1,3 +1,5 @@
+from functools import lru_cache
+
 # """
 # <?xml version='1.0' encoding='utf-8'?>
 # <ns0:package xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:ns0="http://www.idpf.org/2007/opf" version="2.0">
@@ -29,7 +31,8 @@
 # """
 
 
-# Переворачиваем фамилию имя
+# Переворачиваем фамилию имя. Имена чтецов и авторов серий повторяются между книгами
+@lru_cache(maxsize=4096)
 def if_to_fi(person_if):
     split = person_if.split()
     if len(split) == 2:
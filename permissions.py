@@ -0,0 +1,49 @@
+import logging
+import os
+import sys
+from profiler import profile_stage
+
+logger = logging.getLogger(__name__)
+
+# Права по умолчанию соответствуют прежнему chmod -R ugo+wrX
+DEFAULT_FILE_MODE = 0o666
+DEFAULT_DIR_MODE = 0o777
+
+_file_mode = DEFAULT_FILE_MODE
+_dir_mode = DEFAULT_DIR_MODE
+_umask = 0
+
+
+def octal_mode(value):
+    return int(value, 8)
+
+
+def set_permissions(file_mode=DEFAULT_FILE_MODE, dir_mode=DEFAULT_DIR_MODE, umask=None):
+    global _file_mode, _dir_mode, _umask
+    _file_mode = file_mode
+    _dir_mode = dir_mode
+    if umask is not None:
+        os.umask(umask)
+        _umask = umask
+    logger.debug(
+        f"Права файлов: {oct(_file_mode)}, каталогов: {oct(_dir_mode)}, umask: {oct(_umask)}"
+    )
+
+
+def _chmod(path, mode):
+    # В windows права не устанавливаем, как и раньше
+    if sys.platform == "win32":
+        return
+    with profile_stage("chmod"):
+        try:
+            os.chmod(path, mode & ~_umask)
+        except OSError as e:
+            logger.warning(f"Не удалось установить права {oct(mode)} на {path}: {e}")
+
+
+def apply_file_permissions(path):
+    _chmod(path, _file_mode)
+
+
+def apply_dir_permissions(path):
+    _chmod(path, _dir_mode)
@@ -0,0 +1,131 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+from cookie_pool import as_cookie_pool
+from download_book import (
+    get_book_folder_path,
+    get_book_metadata,
+    get_headers,
+    is_book_file_complete,
+)
+from staging import get_work_folder
+from progress import format_size, format_duration
+from throughput import DEFAULT_STATS_FILE, get_recent_throughput
+
+logger = logging.getLogger(__name__)
+
+# Число одновременных запросов метаданных при планировании
+DEFAULT_PLAN_CONCURRENCY = 8
+
+
+def plan_book(url, output, cookie_pool):
+    """Сводка по книге без загрузки: размер, число файлов и сколько уже загружено"""
+    plan = {"url": url, "error": ""}
+    session = cookie_pool.acquire(job=False)
+    if session is None:
+        plan["error"] = "Не осталось действующих cookies"
+        return plan
+    try:
+        book_id = url.split("-")[-1].split("/")[0]
+        book_info, files, status_code, err_msg = get_book_metadata(
+            book_id, session.cookies, get_headers()
+        )
+    finally:
+        cookie_pool.release(session)
+    if err_msg != "":
+        plan["error"] = err_msg
+        return plan
+
+    book_folder = get_book_folder_path(output, book_info)
+    work_folder = get_work_folder(output, book_folder)
+    complete = [
+        file
+        for file in files
+        if is_book_file_complete(work_folder, book_folder, file[1], file[2])
+    ]
+    plan.update(
+        {
+            "title": book_info["title"],
+            "author": book_info["author"],
+            "folder": str(book_folder),
+            "files": len(files),
+            "bytes": sum(file[2] for file in files),
+            "complete_files": len(complete),
+            "complete_bytes": sum(file[2] for file in complete),
+        }
+    )
+    return plan
+
+
+def read_queue(input):
+    with open(input, "r") as f:
+        for url in f:
+            url_trim = url.strip()
+            if "litres.ru" in url_trim:
+                yield url_trim
+
+
+def plan_queue(input, output, cookies, concurrency=DEFAULT_PLAN_CONCURRENCY):
+    """Запрашивает метаданные книг очереди пачками по concurrency одновременных
+    запросов. Файлы книг не загружаются и каталоги не создаются."""
+    cookie_pool = as_cookie_pool(cookies)
+    queue = read_queue(input)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while True:
+            batch = list(islice(queue, concurrency))
+            if len(batch) == 0:
+                break
+            yield from executor.map(
+                lambda url: plan_book(url, output, cookie_pool), batch
+            )
+
+
+def print_plan(input, output, cookies, concurrency, stats_file=DEFAULT_STATS_FILE):
+    """Выводит план загрузки очереди и оценку времени по скорости последних запусков"""
+    books = 0
+    complete_books = 0
+    files = 0
+    total_bytes = 0
+    complete_bytes = 0
+    errors = []
+    for plan in plan_queue(input, output, cookies, concurrency):
+        if plan["error"] != "":
+            errors.append(plan)
+            print(f"ОШИБКА     {plan['url']}: {plan['error']}")
+            continue
+        books += 1
+        files += plan["files"]
+        total_bytes += plan["bytes"]
+        complete_bytes += plan["complete_bytes"]
+        if plan["files"] == 0:
+            status = "нет файлов"
+        elif plan["complete_files"] == plan["files"]:
+            status = "загружена"
+            complete_books += 1
+        elif plan["complete_files"] > 0:
+            status = f"{plan['complete_files']}/{plan['files']} файлов"
+        else:
+            status = "новая"
+        print(
+            f"{status:<10} {format_size(plan['bytes']):>10} {plan['files']:>4} файлов  "
+            f"{plan['author']} - {plan['title']}"
+        )
+
+    remaining = total_bytes - complete_bytes
+    print()
+    print(f"Книг: {books}, из них загружено: {complete_books}, ошибок: {len(errors)}")
+    print(f"Файлов: {files}")
+    print(f"Общий размер: {format_size(total_bytes)}")
+    print(f"Осталось загрузить: {format_size(remaining)}")
+    throughput = get_recent_throughput(stats_file)
+    if throughput > 0:
+        print(
+            f"Оценка времени: {format_duration(remaining / throughput)} "
+            f"при скорости {format_size(throughput)}/с (по последним запускам)"
+        )
+    else:
+        print(
+            f"Оценка времени недоступна: нет статистики загрузки в файле {stats_file}"
+        )
+    return errors
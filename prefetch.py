@@ -0,0 +1,66 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from common import LITRES_URL
+from cover_cache import prefetch_cover
+from download_book import get_book_metadata, get_headers
+
+logger = logging.getLogger(__name__)
+
+# Сколько следующих книг очереди предзагружать по умолчанию
+DEFAULT_PREFETCH = 2
+
+
+class Prefetcher:
+    """Пока загружаются файлы текущей книги, в фоне запрашивает метаданные, список
+    файлов и обложки следующих книг очереди. Результат с ошибкой не сохраняется:
+    download_book повторит запрос сам и обработает ошибку как обычно."""
+
+    def __init__(self, cookie_pool, depth=DEFAULT_PREFETCH, load_cover=False):
+        self.cookie_pool = cookie_pool
+        self.load_cover = load_cover
+        self.executor = ThreadPoolExecutor(max_workers=max(1, depth))
+        self.futures = {}
+
+    def submit(self, url):
+        if url not in self.futures:
+            self.futures[url] = self.executor.submit(self._prefetch, url)
+
+    def pop(self, url):
+        """Результат get_book_metadata для url или None"""
+        future = self.futures.pop(url, None)
+        if future is None:
+            return None
+        try:
+            return future.result()
+        except Exception as e:
+            logger.warning(f"Ошибка предзагрузки {url}: {e}")
+            return None
+
+    def close(self):
+        for future in self.futures.values():
+            future.cancel()
+        self.futures.clear()
+        self.executor.shutdown(wait=True)
+
+    def _prefetch(self, url):
+        # Предзагрузка не считается заданием: иначе она сдвигает распределение
+        # книг между аккаунтами
+        session = self.cookie_pool.acquire(job=False)
+        if session is None:
+            return None
+        try:
+            book_id = url.split("-")[-1].split("/")[0]
+            prefetched = get_book_metadata(
+                book_id, session.cookies, get_headers(), prefetch=True
+            )
+        finally:
+            self.cookie_pool.release(session)
+        book_info, files, status_code, err_msg = prefetched
+        if err_msg != "":
+            logger.debug(f"Предзагрузка не удалась: {err_msg}")
+            return None
+        if self.load_cover:
+            prefetch_cover(f'{LITRES_URL}{book_info["cover"]}')
+        logger.debug(f"Предзагружены метаданные книги: {url}")
+        return prefetched
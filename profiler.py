@@ -0,0 +1,111 @@
+import atexit
+import cProfile
+import io
+import logging
+import pstats
+import sys
+import threading
+import time
+from contextlib import nullcontext
+
+logger = logging.getLogger(__name__)
+
+# Профилирование выключено по умолчанию. В этом случае profile_stage возвращает
+# пустой контекст, поэтому вызовы можно оставлять в рабочем коде.
+_enabled = False
+_lock = threading.Lock()
+# Имя этапа -> [количество, время, процессорное время, максимальное время,
+# этап выполняется одновременно с другими]
+_stats = {}
+_cprofile = None
+_pstats_file = ""
+_null_stage = nullcontext()
+
+
+class _Stage:
+    __slots__ = ("name", "concurrent", "wall", "cpu")
+
+    def __init__(self, name, concurrent=False):
+        self.name = name
+        self.concurrent = concurrent
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        if not self.concurrent:
+            self.cpu = time.thread_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall = time.perf_counter() - self.wall
+        cpu = 0.0 if self.concurrent else time.thread_time() - self.cpu
+        with _lock:
+            stat = _stats.setdefault(self.name, [0, 0.0, 0.0, 0.0, False])
+            stat[0] += 1
+            stat[1] += wall
+            stat[2] += cpu
+            stat[3] = max(stat[3], wall)
+            stat[4] = stat[4] or self.concurrent
+        return False
+
+
+def profile_stage(name, concurrent=False):
+    """concurrent=True - этап содержит await. Пока он ждет, цикл событий выполняет
+    в том же потоке другие загрузки, поэтому thread_time включал бы их работу, а
+    время этапа пересекается с другими. Для таких этапов учитывается только время"""
+    if not _enabled:
+        return _null_stage
+    return _Stage(name, concurrent)
+
+
+def enable_profiling(pstats_file=""):
+    global _enabled, _cprofile, _pstats_file
+    if _enabled:
+        return
+    _enabled = True
+    _pstats_file = pstats_file
+    if pstats_file:
+        _cprofile = cProfile.Profile()
+        _cprofile.enable()
+    atexit.register(print_profile_report)
+
+
+def get_profile_stats():
+    with _lock:
+        return {name: list(stat) for name, stat in _stats.items()}
+
+
+def format_profile_report(stats):
+    # Доля считается только среди последовательных этапов: время одновременных
+    # этапов пересекается, и их сумма не соответствует времени работы
+    total_wall = sum(stat[1] for stat in stats.values() if not stat[4])
+    lines = [
+        f"{'Этап':<28} {'кол-во':>8} {'время, с':>10} {'CPU, с':>10} {'макс, с':>10} {'%':>6}"
+    ]
+    for name, stat in sorted(stats.items(), key=lambda item: item[1][1], reverse=True):
+        count, wall, cpu, max_wall, concurrent = stat
+        if concurrent:
+            lines.append(
+                f"{name + ' *':<28} {count:>8} {wall:>10.3f} {'-':>10} {max_wall:>10.3f} {'-':>6}"
+            )
+            continue
+        share = wall / total_wall * 100 if total_wall > 0 else 0
+        lines.append(
+            f"{name:<28} {count:>8} {wall:>10.3f} {cpu:>10.3f} {max_wall:>10.3f} {share:>6.1f}"
+        )
+    if any(stat[4] for stat in stats.values()):
+        lines.append(
+            "* этапы выполняются одновременно (--engine aiohttp, предзагрузка --prefetch): "
+            "время пересекается, процессорное время и доля не считаются"
+        )
+    return "\n".join(lines)
+
+
+def print_profile_report():
+    print(format_profile_report(get_profile_stats()), file=sys.stderr)
+    if _cprofile is not None:
+        _cprofile.disable()
+        _cprofile.dump_stats(_pstats_file)
+        stream = io.StringIO()
+        pstats.Stats(_cprofile, stream=stream).sort_stats("cumulative").print_stats(20)
+        print(stream.getvalue(), file=sys.stderr)
+        logger.info(f"Данные cProfile записаны в файл {_pstats_file}")
@@ -0,0 +1,234 @@
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# Период обновления сводки и файла состояния, секунд
+DEFAULT_REFRESH = 1.0
+# Текущая скорость считается по последним THROUGHPUT_WINDOW секундам
+THROUGHPUT_WINDOW = 10
+# Без терминала сводка выводится строкой раз в NON_TTY_EVERY обновлений
+NON_TTY_EVERY = 30
+
+# Сводка текущего запуска. None - сводка не ведется
+_progress = None
+
+
+def set_progress(progress):
+    global _progress
+    _progress = progress
+
+
+def get_progress():
+    return _progress
+
+
+def format_size(size):
+    for unit in ["Б", "КБ", "МБ", "ГБ"]:
+        if abs(size) < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} ТБ"
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+
+def count_queue(input):
+    with open(input, "r") as f:
+        return sum(1 for url in f if "litres.ru" in url)
+
+
+class Progress:
+    """Общий ход загрузки всех книг: счетчики обновляются при загрузке файлов,
+    а сводка выводится и файл состояния записывается отдельным потоком раз в
+    refresh секунд. Вместо индикатора на каждый файл - одна сводка на запуск."""
+
+    def __init__(
+        self, books_total=0, status_file="", refresh=DEFAULT_REFRESH, show=True
+    ):
+        self.books_total = books_total
+        self.status_file = status_file
+        self.refresh = refresh
+        self.show = show
+        self.lock = threading.Lock()
+        self.bytes_done = 0
+        self.bytes_total = 0
+        self.books_started = 0
+        self.books_done = 0
+        self.books_failed = 0
+        # Состояние по исполнителям: книга в работе или процесс загрузки
+        self.workers = {}
+        # Байты, загруженные в других процессах (sharded_loader)
+        self.external_bytes = None
+        self.samples = deque()
+        self.started = time.time()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.lines = 0
+        self.renders = 0
+
+    def add_bytes(self, size):
+        with self.lock:
+            self.bytes_done += size
+
+    def skip_bytes(self, size):
+        # Файл уже загружен ранее: не загружается и не влияет на скорость
+        with self.lock:
+            self.bytes_total -= size
+
+    def set_worker(self, key, status):
+        with self.lock:
+            self.workers[key] = status
+
+    def remove_worker(self, key):
+        with self.lock:
+            self.workers.pop(key, None)
+
+    def start_book(self, key, title, size, files):
+        with self.lock:
+            # Повтор книги после смены cookies не увеличивает общий объем
+            if key not in self.workers:
+                self.bytes_total += size
+                self.books_started += 1
+            self.workers[key] = f"{title}: 0/{files} файлов"
+
+    def abort_book(self, key, size):
+        """Загрузка книги прервана вместе с процессом загрузки (sharded_loader)
+        и начнется заново: ее размер (без пропущенных файлов) убирается из общего
+        объема, иначе перезапущенный процесс учел бы книгу второй раз"""
+        with self.lock:
+            self.workers.pop(key, None)
+            self.bytes_total -= size
+            self.books_started -= 1
+
+    def update_book(self, key, title, files_done, files):
+        self.set_worker(key, f"{title}: {files_done}/{files} файлов")
+
+    def finish_book(self, key, ok=True):
+        with self.lock:
+            self.workers.pop(key, None)
+            if ok:
+                self.books_done += 1
+            else:
+                self.books_failed += 1
+
+    def snapshot(self, state="running"):
+        now = time.time()
+        with self.lock:
+            bytes_done = self.bytes_done
+            if self.external_bytes is not None:
+                bytes_done += self.external_bytes()
+            status = {
+                "state": state,
+                "time": int(now),
+                "elapsed_sec": round(now - self.started, 1),
+                "bytes_done": bytes_done,
+                "bytes_total": self.bytes_total,
+                "books_total": self.books_total,
+                "books_done": self.books_done,
+                "books_failed": self.books_failed,
+                "books_remaining": max(
+                    0, self.books_total - self.books_done - self.books_failed
+                ),
+                "workers": dict(self.workers),
+            }
+            books_started = self.books_started
+
+        self.samples.append((now, bytes_done))
+        while now - self.samples[0][0] > THROUGHPUT_WINDOW:
+            self.samples.popleft()
+        first_time, first_bytes = self.samples[0]
+        throughput = (
+            (bytes_done - first_bytes) / (now - first_time) if now > first_time else 0
+        )
+        # Размер еще не начатых книг оцениваем по среднему размеру начатых
+        remaining = max(0, status["bytes_total"] - bytes_done)
+        if books_started > 0:
+            not_started = max(0, status["books_total"] - books_started)
+            remaining += status["bytes_total"] / books_started * not_started
+        status["throughput_bps"] = round(throughput)
+        status["eta_sec"] = round(remaining / throughput) if throughput > 0 else None
+        return status
+
+    def render(self, state="running"):
+        status = self.snapshot(state)
+        if self.status_file:
+            self.write_status(status)
+        if self.show:
+            self.draw(status)
+
+    def write_status(self, status):
+        # Файл заменяется целиком, читатель не увидит половину json
+        try:
+            path = Path(self.status_file)
+            with tempfile.NamedTemporaryFile(
+                "w", dir=path.absolute().parent, delete=False
+            ) as f:
+                json.dump(status, f, ensure_ascii=False)
+            os.replace(f.name, path)
+        except OSError as e:
+            logger.warning(
+                f"Не удалось записать файл состояния {self.status_file}: {e}"
+            )
+
+    def format_lines(self, status):
+        eta = status["eta_sec"]
+        total = status["bytes_total"]
+        lines = [
+            f"Книги: {status['books_done']}/{status['books_total']}"
+            f" (ошибок {status['books_failed']}, осталось {status['books_remaining']})"
+            f" | {format_size(status['bytes_done'])}"
+            + (f" из {format_size(total)}" if total > 0 else "")
+            + f" | {format_size(status['throughput_bps'])}/с"
+            f" | осталось времени {format_duration(eta) if eta is not None else '?'}"
+        ]
+        for key, worker_status in sorted(status["workers"].items()):
+            lines.append(f"  {worker_status}")
+        return lines
+
+    def draw(self, status):
+        lines = self.format_lines(status)
+        if sys.stderr.isatty():
+            # Перерисовываем предыдущую сводку на месте
+            clear = "\x1b[F\x1b[K" * self.lines
+            sys.stderr.write(clear + "\n".join(lines) + "\n")
+            self.lines = len(lines)
+        elif status["state"] != "running" or self.renders % NON_TTY_EVERY == 0:
+            sys.stderr.write(lines[0] + "\n")
+        self.renders += 1
+        sys.stderr.flush()
+
+    def run(self):
+        while not self.stopped.wait(self.refresh):
+            self.render()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self, state="finished"):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.render(state)
+
+
+def start_progress(books_total, show, status_file="", refresh=DEFAULT_REFRESH):
+    """Запускает сводку, если нужен вывод на экран или файл состояния"""
+    if not show and not status_file:
+        return None
+    progress = Progress(books_total, status_file, refresh, show)
+    set_progress(progress)
+    progress.start()
+    return progress
@@ -0,0 +1,435 @@
+import logging
+import multiprocessing
+import multiprocessing.connection
+import tempfile
+import threading
+import time
+import zlib
+from pathlib import Path
+
+from common import AuthError
+from cookie_pool import CookiePool, as_cookie_pool, download_with_pool
+from cover_cache import set_cover_cache
+from disk_space import DiskSpace, SharedReservations, DEFAULT_RESERVE_MB
+from file_policy import get_file_policy, set_file_policy
+from staging import set_staging
+from progress import get_progress, set_progress
+from permissions import set_permissions
+from tg_sender import send_to_telegram
+from throughput import add_transferred, set_shared_counter
+
+logger = logging.getLogger(__name__)
+
+# Сколько раз процесс может упасть на одной книге. После этого книга считается
+# ошибкой и пропускается, шард продолжается со следующей. Столько же раз подряд
+# перезапускается процесс, падающий без продвижения по шарду (например, при запуске)
+MAX_RESTARTS = 3
+# Как часто проверять, что процессы работают, секунд
+WORKER_CHECK_INTERVAL = 1
+
+
+def get_shard_key(url):
+    """Ключ распределения по процессам - автор из адреса книги:
+    https://www.litres.ru/audiobook/{автор}/{название-id}/
+    Все книги одного автора попадают в один процесс, поэтому каталоги
+    get_book_folder разных процессов не пересекаются."""
+    parts = [part for part in url.split("?")[0].split("/") if part]
+    if len(parts) >= 5:
+        return parts[-2]
+    return parts[-1] if len(parts) > 0 else url
+
+
+def split_queue(input, workdir, processes):
+    shard_files = [Path(workdir) / f"shard_{num}.txt" for num in range(processes)]
+    files = [open(shard_file, "w") for shard_file in shard_files]
+    total = 0
+    try:
+        with open(input, "r") as f:
+            for url in f:
+                url_trim = url.strip()
+                if "litres.ru" in url_trim:
+                    num = zlib.crc32(get_shard_key(url_trim).encode()) % processes
+                    files[num].write(url_trim + "\n")
+                    total += 1
+    finally:
+        for f in files:
+            f.close()
+    return shard_files, total
+
+
+def read_position(position_file):
+    """Смещения в файле шарда и в файле отложенных адресов, до которых адреса
+    уже обработаны, и сколько раз начиналась загрузка следующей книги. Хранятся
+    смещения, а не сами адреса, чтобы память процесса не росла с длиной очереди"""
+    try:
+        shard_pos, deferred_pos, attempts = Path(position_file).read_text().split()
+        return int(shard_pos), int(deferred_pos), int(attempts)
+    except (OSError, ValueError):
+        return 0, 0, 0
+
+
+def write_position(f, shard_pos, deferred_pos, attempts=0):
+    # Запись в файл, а не событие родительскому процессу: при падении процесса
+    # события из очереди могут не дойти
+    f.seek(0)
+    f.write(f"{shard_pos} {deferred_pos} {attempts}\n")
+    f.truncate()
+    f.flush()
+
+
+class EventSender:
+    """События процесса шарда родительскому процессу по собственному каналу
+    процесса. Общая multiprocessing.Queue не подходит: процесс, убитый во время
+    записи в нее, оставляет занятой ее общую блокировку, и остальные процессы
+    зависают. Запись в канал синхронная, поэтому события, отправленные до
+    падения, не теряются"""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.lock = threading.Lock()
+
+    def put(self, event):
+        with self.lock:
+            self.connection.send(event)
+
+
+class ShardProgress:
+    """Ход загрузки в процессе шарда для общей сводки родительского процесса.
+    Байты пишутся в ячейку процесса общего массива (в нее пишет только этот
+    процесс), состояние книги передается событиями"""
+
+    def __init__(self, num, shared_bytes, events):
+        self.num = num
+        self.shared_bytes = shared_bytes
+        self.events = events
+
+    def add_bytes(self, size):
+        self.shared_bytes[self.num] += size
+
+    def skip_bytes(self, size):
+        self.events.put(("skip", self.num, "", size))
+
+    def start_book(self, key, title, size, files):
+        # Байты процесса к началу книги: если процесс упадет, родительский процесс
+        # вернет к ним ячейку, и байты прерванной загрузки не учтутся дважды
+        bytes_done = self.shared_bytes[self.num]
+        self.events.put(("started", self.num, key, title, size, files, bytes_done))
+
+    def update_book(self, key, title, files_done, files):
+        self.events.put(("file", self.num, key, title, files_done, files))
+
+    def finish_book(self, key, ok=True):
+        # Завершение книги родительский процесс учитывает по событиям done и error
+        pass
+
+
+def run_shard(
+    num,
+    shard_file,
+    output,
+    cookies_dicts,
+    cookies_strategy,
+    refresh_lock,
+    progressbar,
+    load_cover,
+    create_metadata,
+    engine,
+    reserve_bytes,
+    reservations,
+    permissions,
+    cover_cache,
+    file_policy,
+    staging,
+    shared_bytes,
+    transferred,
+    events,
+):
+    """Процесс загрузки книг одного шарда. Смещение после последнего обработанного
+    адреса записывается в файл shard_N.txt.pos, поэтому после перезапуска процесс
+    продолжает с места падения. Книга, на которой процесс упал MAX_RESTARTS раз,
+    пропускается с ошибкой.
+    Телеграм процессы не используют: о ходе загрузки сообщает родительский процесс."""
+    if engine == "aiohttp":
+        from async_engine import download_book
+    else:
+        from download_book import download_book
+
+    events = EventSender(events)
+    set_permissions(*permissions)
+    set_cover_cache(*cover_cache)
+    set_file_policy(file_policy)
+    set_staging(*staging)
+    set_shared_counter(transferred, num)
+    if shared_bytes is not None:
+        set_progress(ShardProgress(num, shared_bytes, events))
+    # Cookies уже проверены родительским процессом. Процессы начинают с разных
+    # сессий пула, чтобы распределить аккаунты между ними.
+    cookie_pool = CookiePool.from_dicts(
+        cookies_dicts, cookies_strategy, start=num, refresh_lock=refresh_lock
+    )
+    # Резерв места общий для всех процессов: иначе каждый процесс мог бы
+    # зарезервировать одно и то же свободное место
+    disk_space = DiskSpace(output, reserve_bytes, shared=reservations, slot=num)
+    position_file = Path(f"{shard_file}.pos")
+    deferred_file = Path(f"{shard_file}.deferred")
+    shard_pos, deferred_pos, attempts = read_position(position_file)
+    position_file.touch()
+
+    def load(url):
+        try:
+            return download_with_pool(
+                cookie_pool,
+                download_book,
+                url,
+                output,
+                "",
+                "",
+                progressbar,
+                load_cover,
+                create_metadata,
+                False,
+                disk_space,
+            )
+        except (SystemExit, AuthError):
+            # download_book завершает программу при ошибке загрузки книги.
+            # Здесь ошибка относится только к одной книге, продолжаем шард.
+            return None
+        except Exception:
+            # Сетевая ошибка, ошибка записи или неожиданный ответ сервера тоже
+            # относятся к одной книге: процесс не должен из-за нее падать
+            logger.exception(f"Непредвиденная ошибка при загрузке книги: {url}")
+            return None
+
+    def load_counted(pos_f, url):
+        nonlocal attempts
+        if attempts >= MAX_RESTARTS:
+            logger.error(f"Процесс {num} падал на книге {attempts} раз, пропуск: {url}")
+            attempts = 0
+            return None
+        attempts += 1
+        write_position(pos_f, shard_pos, deferred_pos, attempts)
+        result = load(url)
+        attempts = 0
+        return result
+
+    with open(position_file, "r+") as pos_f, open(deferred_file, "a+") as deferred_f:
+        with open(shard_file, "r") as f:
+            f.seek(shard_pos)
+            # readline, а не итерация по файлу: при итерации tell недоступен
+            for url in iter(f.readline, ""):
+                url = url.strip()
+                result = load_counted(pos_f, url)
+                if result is False:
+                    deferred_f.write(url + "\n")
+                    deferred_f.flush()
+                    events.put(("deferred", num, url))
+                else:
+                    events.put(("done" if result else "error", num, url))
+                shard_pos = f.tell()
+                write_position(pos_f, shard_pos, deferred_pos)
+
+        # Повторная попытка для книг, которым не хватило места
+        deferred_f.seek(deferred_pos)
+        for url in iter(deferred_f.readline, ""):
+            url = url.strip()
+            result = load_counted(pos_f, url)
+            if result is None:
+                events.put(("error", num, url))
+            else:
+                events.put(("done" if result else "no_space", num, url))
+            deferred_pos = deferred_f.tell()
+            write_position(pos_f, shard_pos, deferred_pos)
+
+
+def download_books_sharded(
+    input,
+    output,
+    cookies,
+    tg_api_key,
+    tg_chat_id,
+    progressbar,
+    load_cover,
+    create_metadata,
+    processes,
+    engine="requests",
+    reserve_bytes=DEFAULT_RESERVE_MB * 1024 * 1024,
+    permissions=(),
+    cover_cache=(),
+    file_policy=None,
+    staging=(),
+):
+    """cookies - одиночные cookies или CookiePool. Процессы получают копию пула."""
+    if file_policy is None:
+        file_policy = get_file_policy()
+    with tempfile.TemporaryDirectory() as workdir:
+        shard_files, total = split_queue(input, workdir, processes)
+        msg = f"Начало загрузки {total} книг в {processes} процессах"
+        logger.info(msg)
+        send_to_telegram(msg, tg_api_key, tg_chat_id)
+
+        # Каналы событий процессов
+        readers = {}
+        # Общая сводка: байты процессов в общем массиве, по ячейке на процесс
+        progress = get_progress()
+        shared_bytes = None
+        if progress is not None:
+            shared_bytes = multiprocessing.Array("q", processes, lock=False)
+            progress.external_bytes = lambda: sum(shared_bytes)
+        cookie_pool = as_cookie_pool(cookies)
+        cookies_dicts = cookie_pool.to_dicts()
+        # Загруженные процессами байты для статистики скорости (--plan)
+        transferred = multiprocessing.Array("q", processes, lock=False)
+        reservations = SharedReservations(processes)
+        refresh_lock = multiprocessing.Lock()
+
+        def start(num):
+            # Резерв упавшего процесса больше не нужен
+            reservations.reset(num)
+            reader, writer = multiprocessing.Pipe(duplex=False)
+            readers[num] = reader
+            process = multiprocessing.Process(
+                target=run_shard,
+                args=(
+                    num,
+                    shard_files[num],
+                    output,
+                    cookies_dicts,
+                    cookie_pool.strategy,
+                    refresh_lock,
+                    progressbar,
+                    load_cover,
+                    create_metadata,
+                    engine,
+                    reserve_bytes,
+                    reservations,
+                    permissions,
+                    cover_cache,
+                    file_policy,
+                    staging,
+                    shared_bytes,
+                    transferred,
+                    writer,
+                ),
+            )
+            process.start()
+            writer.close()
+            return process
+
+        workers = {num: start(num) for num in range(processes)}
+        # Падения подряд без продвижения по шарду и позиция при последнем падении
+        restarts = {num: 0 for num in range(processes)}
+        crash_positions = {}
+        # Книга в работе у процесса: размер без пропущенных файлов и байты процесса
+        # к ее началу
+        in_flight = {}
+        done_count = 0
+        errors = []
+        not_loaded = []
+        failed_shards = []
+
+        def handle(event):
+            nonlocal done_count
+            status, num, url = event[:3]
+            worker = f"процесс {num}"
+            if progress is not None:
+                if status == "started":
+                    title, size, files, bytes_done = event[3:]
+                    in_flight[num] = [size, bytes_done]
+                    progress.start_book(worker, f"{worker}: {title}", size, files)
+                elif status == "file":
+                    title, files_done, files = event[3:]
+                    progress.update_book(
+                        worker, f"{worker}: {title}", files_done, files
+                    )
+                elif status == "skip":
+                    if num in in_flight:
+                        in_flight[num][0] -= event[3]
+                    progress.skip_bytes(event[3])
+                elif status in ["done", "error", "no_space"]:
+                    in_flight.pop(num, None)
+                    progress.finish_book(worker, status == "done")
+            if status == "done":
+                done_count += 1
+                msg = f"Загружено книг {done_count} из {total}: {url}"
+                logger.info(msg)
+                send_to_telegram(msg, tg_api_key, tg_chat_id)
+            elif status == "error":
+                errors.append(url)
+                logger.error(f"Ошибка загрузки книги (процесс {num}): {url}")
+            elif status == "no_space":
+                not_loaded.append(url)
+            elif status == "deferred":
+                logger.warning(f"Загрузка отложена (процесс {num}): {url}")
+
+        def receive(num):
+            try:
+                handle(readers[num].recv())
+            except (EOFError, OSError):
+                # Процесс завершился, а сообщение, которое он не успел дописать
+                # при падении, отбрасывается
+                readers.pop(num).close()
+
+        def receive_ready(timeout):
+            ready = multiprocessing.connection.wait(list(readers.values()), timeout)
+            for num, reader in list(readers.items()):
+                if reader in ready:
+                    receive(num)
+
+        # Процессы проверяются по времени, а не только при отсутствии событий:
+        # при общей сводке события идут постоянно
+        next_check = time.monotonic() + WORKER_CHECK_INTERVAL
+        while len(workers) > 0:
+            receive_ready(max(0, next_check - time.monotonic()))
+            if time.monotonic() < next_check:
+                continue
+            next_check = time.monotonic() + WORKER_CHECK_INTERVAL
+            for num, process in list(workers.items()):
+                if process.is_alive():
+                    continue
+                # Дочитываем события процесса, прежде чем решать о перезапуске
+                while num in readers:
+                    receive(num)
+                if progress is not None:
+                    book = in_flight.pop(num, None)
+                    if book is not None and process.exitcode != 0:
+                        # Книга будет загружена заново перезапущенным процессом
+                        size, bytes_done = book
+                        shared_bytes[num] = bytes_done
+                        progress.abort_book(f"процесс {num}", size)
+                    else:
+                        progress.remove_worker(f"процесс {num}")
+                if process.exitcode == 0:
+                    del workers[num]
+                    continue
+                # Падения считаются с последнего продвижения по шарду, а не за
+                # всю загрузку: отдельные сбои за долгую загрузку не останавливают
+                # шард, а на повторно падающей книге процесс пропустит ее сам
+                position = read_position(f"{shard_files[num]}.pos")[:2]
+                if crash_positions.get(num) != position:
+                    restarts[num] = 0
+                crash_positions[num] = position
+                if restarts[num] < MAX_RESTARTS:
+                    restarts[num] += 1
+                    logger.warning(
+                        f"Процесс {num} завершился с кодом {process.exitcode}, "
+                        f"перезапуск {restarts[num]} из {MAX_RESTARTS}"
+                    )
+                    workers[num] = start(num)
+                else:
+                    logger.error(f"Процесс {num} не удалось перезапустить")
+                    failed_shards.append(num)
+                    del workers[num]
+
+        # Статистику скорости сохраняет родительский процесс (throughput.record_run)
+        add_transferred(sum(transferred))
+
+    msg = f"Окончание загрузки. Загружено книг {done_count} из {total}"
+    if len(errors) > 0:
+        msg += "\nОшибки загрузки:\n" + "\n".join(errors)
+    if len(not_loaded) > 0:
+        msg += f"\nНедостаточно места в каталоге {output}:\n" + "\n".join(not_loaded)
+    if len(failed_shards) > 0:
+        msg += f"\nНе завершены процессы: {failed_shards}"
+    logger.info(msg)
+    send_to_telegram(msg, tg_api_key, tg_chat_id)
+    return not_loaded
@@ -0,0 +1,155 @@
+import logging
+import os
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+
+from permissions import apply_dir_permissions
+from profiler import profile_stage
+
+logger = logging.getLogger(__name__)
+
+# Политика fsync: none - не вызывать, file - после записи каждого файла книги,
+# book - один раз для всех файлов книги перед переносом в каталог загрузки
+FSYNC_NONE = "none"
+FSYNC_FILE = "file"
+FSYNC_BOOK = "book"
+# Размер буфера записи файлов книги
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+# Пустая строка - книги записываются сразу в каталог загрузки, как раньше
+_staging_dir = ""
+_fsync = FSYNC_NONE
+
+
+def set_staging(staging_dir="", fsync=FSYNC_NONE):
+    global _staging_dir, _fsync
+    _staging_dir = str(staging_dir) if staging_dir else ""
+    _fsync = fsync
+    logger.debug(f"Каталог подготовки: {_staging_dir or 'не задан'}, fsync: {_fsync}")
+
+
+def get_staging_dir():
+    """Каталог подготовки или пустая строка, если он не задан"""
+    return _staging_dir
+
+
+def get_work_folder(output, book_folder):
+    """Каталог, в который записываются файлы книги до переноса в book_folder.
+    Структура каталогов внутри каталога подготовки та же, что и в output"""
+    if _staging_dir == "":
+        return Path(book_folder)
+    return Path(_staging_dir) / Path(book_folder).relative_to(output)
+
+
+def finish_file(f):
+    """Вызывается для открытого файла книги после записи"""
+    if _fsync == FSYNC_FILE:
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _fsync_path(path):
+    with open(path, "rb") as f:
+        os.fsync(f.fileno())
+
+
+def _fsync_dir(path):
+    # В windows каталог нельзя открыть для fsync
+    if sys.platform == "win32":
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _fsync_files(folder):
+    for path in Path(folder).iterdir():
+        if path.is_file():
+            _fsync_path(path)
+    _fsync_dir(folder)
+
+
+def _copy_files(src_folder, dst_folder):
+    for path in Path(src_folder).iterdir():
+        if path.is_file():
+            shutil.copy2(path, Path(dst_folder) / path.name)
+
+
+def _remove_empty_parents(work_folder):
+    """Удаляет опустевшие каталоги автора и серии в каталоге подготовки,
+    поднимаясь от каталога книги до корня каталога подготовки"""
+    root = Path(_staging_dir).absolute()
+    folder = Path(work_folder).absolute().parent
+    while folder != root and root in folder.parents:
+        try:
+            # Непустой каталог не удаляется: в нем есть другие книги
+            os.rmdir(folder)
+        except OSError:
+            return
+        folder = folder.parent
+
+
+def commit_book(work_folder, book_folder):
+    """Переносит загруженную книгу из каталога подготовки в каталог книги.
+    Если каталога книги еще нет, книга появляется в нем целиком: переименованием
+    каталога на той же файловой системе или копированием во временный каталог
+    рядом с ним и переименованием. Иначе файлы заменяются по одному."""
+    work_folder = Path(work_folder)
+    book_folder = Path(book_folder)
+    if work_folder == book_folder:
+        if _fsync == FSYNC_BOOK:
+            with profile_stage("fsync"):
+                _fsync_files(book_folder)
+        return
+
+    with profile_stage("staging commit"):
+        book_folder.parent.mkdir(exist_ok=True, parents=True)
+        same_device = os.stat(work_folder).st_dev == os.stat(book_folder.parent).st_dev
+        if not book_folder.exists():
+            if same_device:
+                if _fsync == FSYNC_BOOK:
+                    _fsync_files(work_folder)
+                os.rename(work_folder, book_folder)
+            else:
+                temp_folder = Path(
+                    tempfile.mkdtemp(dir=book_folder.parent, prefix=".staging-")
+                )
+                try:
+                    _copy_files(work_folder, temp_folder)
+                    if _fsync == FSYNC_BOOK:
+                        _fsync_files(temp_folder)
+                    apply_dir_permissions(temp_folder)
+                    os.rename(temp_folder, book_folder)
+                except BaseException:
+                    shutil.rmtree(temp_folder, ignore_errors=True)
+                    raise
+                shutil.rmtree(work_folder)
+        else:
+            # Каталог книги уже есть (например, с частью файлов прежней загрузки)
+            for path in list(work_folder.iterdir()):
+                if not path.is_file():
+                    continue
+                target = book_folder / path.name
+                if same_device:
+                    if _fsync == FSYNC_BOOK:
+                        _fsync_path(path)
+                    os.replace(path, target)
+                else:
+                    with tempfile.NamedTemporaryFile(
+                        dir=book_folder, prefix=".staging-", delete=False
+                    ) as f:
+                        temp_file = Path(f.name)
+                    shutil.copy2(path, temp_file)
+                    if _fsync == FSYNC_BOOK:
+                        _fsync_path(temp_file)
+                    os.replace(temp_file, target)
+            shutil.rmtree(work_folder)
+        _remove_empty_parents(work_folder)
+        if _fsync == FSYNC_BOOK:
+            _fsync_dir(book_folder)
+            _fsync_dir(book_folder.parent)
+    logger.info(f"Книга перенесена в каталог: {book_folder}")
@@ -0,0 +1,158 @@
+import unittest
+
+from disk_space import DiskSpace, SharedReservations
+from staging import set_staging
+
+
+class FakeDisk:
+    """Свободное место файловых систем для подмены free_space_provider.
+    Каждый путь - отдельная файловая система, если не задан devices"""
+
+    def __init__(self, devices=None, **free):
+        self.free = free
+        self.devices = devices or {}
+
+    def __call__(self, path):
+        return self.free[path]
+
+    def device(self, path):
+        return self.devices.get(path, path)
+
+
+class DiskSpaceTest(unittest.TestCase):
+    def setUp(self):
+        set_staging()
+        self.addCleanup(set_staging)
+        self.disk = FakeDisk(output=1000)
+        self.disk_space = self.create_disk_space()
+
+    def create_disk_space(self, shared=None, slot=0):
+        return DiskSpace(
+            "output",
+            reserve_bytes=100,
+            free_space_provider=self.disk,
+            shared=shared,
+            slot=slot,
+            device_provider=self.disk.device,
+        )
+
+    def test_reserve_and_defer(self):
+        # Свободно 1000, запас 100: книге a на 500 места хватает
+        self.assertTrue(self.disk_space.try_reserve("a", 500))
+        # Для книги b осталось 1000 - 500 - 100 = 400, книга откладывается
+        self.assertFalse(self.disk_space.try_reserve("b", 450))
+        self.assertNotIn("b", self.disk_space.reserved)
+
+    def test_consume_and_release(self):
+        self.assertTrue(self.disk_space.try_reserve("a", 500))
+        # Книга a записывает 300 байт: место на диске и резерв уменьшаются вместе,
+        # доступно по-прежнему 400
+        self.disk.free["output"] -= 300
+        self.disk_space.consume("a", 300)
+        self.assertEqual(self.disk_space.reserved["a"], 200)
+        self.assertFalse(self.disk_space.try_reserve("b", 450))
+        # Книга a дописана и завершена, резерв освобожден
+        self.disk.free["output"] -= 200
+        self.disk_space.consume("a", 200)
+        self.disk_space.release("a")
+        self.assertEqual(self.disk_space.reserved, {})
+        # Место освободилось (удалены другие файлы), отложенная книга помещается
+        self.disk.free["output"] += 100
+        self.assertTrue(self.disk_space.try_reserve("b", 450))
+
+    def test_consume_more_than_reserved(self):
+        self.assertTrue(self.disk_space.try_reserve("a", 100))
+        self.disk_space.consume("a", 1000)
+        self.assertEqual(self.disk_space.reserved["a"], 0)
+
+    def test_release_without_writing(self):
+        # Загрузка с ошибкой освобождает резерв без записи
+        self.assertTrue(self.disk_space.try_reserve("a", 100))
+        self.disk_space.release("a")
+        self.assertEqual(self.disk_space.reserved, {})
+        self.assertTrue(self.disk_space.try_reserve("b", 900))
+
+    def test_shared_reservations(self):
+        # Два процесса с общим резервом: место, зарезервированное одним,
+        # недоступно другому
+        shared = SharedReservations(2)
+        first = self.create_disk_space(shared, 0)
+        second = self.create_disk_space(shared, 1)
+        self.assertTrue(first.try_reserve("a", 500))
+        self.assertFalse(second.try_reserve("b", 450))
+        first.consume("a", 200)
+        self.assertEqual(list(shared.slots), [300, 0])
+        # Первый процесс упал, не освободив резерв. После обнуления его ячейки
+        # место снова доступно второму
+        shared.reset(0)
+        self.assertTrue(second.try_reserve("b", 450))
+        self.assertEqual(list(shared.slots), [0, 450])
+        second.release("b")
+        self.assertEqual(sum(shared.slots), 0)
+
+    def test_staging_on_smaller_filesystem(self):
+        # Каталог подготовки на другой файловой системе, где места меньше
+        self.disk.free["staging"] = 300
+        set_staging("staging")
+        self.assertFalse(self.disk_space.try_reserve("a", 500))
+        self.assertTrue(self.disk_space.try_reserve("a", 200))
+
+    def test_staged_book_keeps_output_reservation(self):
+        # Файлы книги a записаны в каталог подготовки на другой файловой системе,
+        # но еще не перенесены: в каталоге загрузки место под них занято до
+        # переноса, иначе книга b заняла бы его второй раз
+        self.disk.free["staging"] = 5000
+        set_staging("staging")
+        self.assertTrue(self.disk_space.try_reserve("a", 800))
+        self.disk.free["staging"] -= 800
+        self.disk_space.consume("a", 800)
+        self.assertEqual(self.disk_space.reserved["a"], 800)
+        self.assertEqual(self.disk_space.staged["a"], 0)
+        self.assertFalse(self.disk_space.try_reserve("b", 900))
+        # Книга a перенесена в каталог загрузки и освобождена
+        self.disk.free["output"] -= 800
+        self.disk.free["staging"] += 800
+        self.disk_space.release("a")
+        self.assertFalse(self.disk_space.try_reserve("b", 900))
+        self.assertTrue(self.disk_space.try_reserve("b", 100))
+
+    def test_staged_files_already_written(self):
+        # Часть файлов книги уже в каталоге подготовки с прошлого запуска:
+        # записать осталось 200, но в каталог загрузки при переносе добавится 600
+        self.disk.free["staging"] = 5000
+        set_staging("staging")
+        self.assertFalse(self.disk_space.try_reserve("a", 200, output_size=1000))
+        self.assertTrue(self.disk_space.try_reserve("a", 200, output_size=600))
+        self.assertEqual(self.disk_space.reserved["a"], 600)
+        self.assertEqual(self.disk_space.staged["a"], 200)
+
+    def test_staging_on_same_filesystem(self):
+        # Каталог подготовки на той же файловой системе: перенос - переименование,
+        # место занимается при записи, как без каталога подготовки
+        self.disk.devices = {"output": 1, "staging": 1}
+        set_staging("staging")
+        self.assertTrue(self.disk_space.try_reserve("a", 500, output_size=800))
+        self.assertEqual(self.disk_space.staged, {})
+        self.disk.free["output"] -= 300
+        self.disk_space.consume("a", 300)
+        self.assertEqual(self.disk_space.reserved["a"], 200)
+
+    def test_shared_staged_reservations(self):
+        shared = SharedReservations(2)
+        first = self.create_disk_space(shared, 0)
+        second = self.create_disk_space(shared, 1)
+        self.disk.free["staging"] = 5000
+        set_staging("staging")
+        self.assertTrue(first.try_reserve("a", 800))
+        first.consume("a", 800)
+        self.assertEqual(list(shared.slots), [800, 0])
+        self.assertEqual(list(shared.staged_slots), [0, 0])
+        self.assertFalse(second.try_reserve("b", 900))
+        shared.reset(0)
+        self.assertEqual(list(shared.slots), [0, 0])
+        self.assertTrue(second.try_reserve("b", 800))
+        self.assertEqual(list(shared.staged_slots), [0, 800])
+
+
+if __name__ == "__main__":
+    unittest.main()
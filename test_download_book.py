@@ -0,0 +1,79 @@
+import io
+import json
+import unittest
+
+import download_book
+from download_book import get_files_to_download, read_groups_info
+
+
+class FakeResponse:
+    """Ответ /files/grouped для read_groups_info"""
+
+    def __init__(self, payload):
+        self.body = json.dumps(payload).encode()
+        self.headers = {"content-length": str(len(self.body))}
+        self.raw = io.BytesIO(self.body)
+
+    def json(self):
+        return json.loads(self.body)
+
+
+def create_grouped(files):
+    return {
+        "payload": {
+            "data": [
+                {
+                    "file_type": "standard_quality_mp3",
+                    "files": [
+                        {
+                            "id": num,
+                            "filename": f"{num:05d}.mp3",
+                            "extension": "mp3",
+                            "size": 1000 + num,
+                            "seconds": num + 0.5,
+                        }
+                        for num in range(files)
+                    ],
+                },
+                {
+                    "file_type": "mobile_version_mp4",
+                    "files": [
+                        {
+                            "id": 100000,
+                            "filename": "book.m4b",
+                            "extension": "m4b",
+                            "size": 5000,
+                        }
+                    ],
+                },
+            ]
+        }
+    }
+
+
+class ReadGroupsInfoTest(unittest.TestCase):
+    def test_small_response(self):
+        payload = create_grouped(3)
+        groups_info = read_groups_info(FakeResponse(payload))
+        self.assertEqual(groups_info, payload["payload"]["data"])
+
+    @unittest.skipIf(download_book.ijson is None, "ijson не установлен")
+    def test_large_response_is_streamed(self):
+        # Ответ больше STREAM_JSON_MIN_SIZE разбирается потоком, а результат
+        # тот же, что и при разборе целиком, включая типы чисел
+        payload = create_grouped(20000)
+        res = FakeResponse(payload)
+        self.assertGreaterEqual(len(res.body), download_book.STREAM_JSON_MIN_SIZE)
+        groups_info = read_groups_info(res)
+        self.assertNotIsInstance(groups_info, list)
+        groups_info = list(groups_info)
+        self.assertEqual(groups_info, payload["payload"]["data"])
+        self.assertIsInstance(groups_info[0]["files"][0]["seconds"], float)
+        self.assertEqual(
+            get_files_to_download("1", groups_info),
+            get_files_to_download("1", payload["payload"]["data"]),
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
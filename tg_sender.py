@@ -1,7 +1,10 @@
 import requests
 import logging
+import os
+from profiler import profile_stage
 
 logger = logging.getLogger(__name__)
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org")
 
 
 def send_to_telegram(msg, tg_api_key, tg_chat_id):
@@ -9,9 +12,10 @@ def send_to_telegram(msg, tg_api_key, tg_chat_id):
         f"Вызвана процедура: send_to_telegram(msg={msg}, tg_api_key={tg_api_key}, tg_chat_id={tg_chat_id})"
     )
     if len(tg_api_key) > 0 and len(tg_chat_id) > 0:
-        url = f"https://api.telegram.org/bot{tg_api_key}/sendMessage"
+        url = f"{TELEGRAM_API_URL}/bot{tg_api_key}/sendMessage"
         data = {"chat_id": tg_chat_id, "text": msg}
-        res = requests.post(url, data=data)
+        with profile_stage("telegram"):
+            res = requests.post(url, data=data)
         if res.ok:
             logger.info("Отправлено сообщение в телеграм")
         else:
@@ -26,10 +30,11 @@ def send_file_to_telegram(filename, tg_api_key, tg_chat_id):
         f"Вызвана процедура: send_file_toTelegram(filename={filename}, tg_api_key={tg_api_key}, tg_chat_id={tg_chat_id})"
     )
     if len(tg_api_key) > 0 and len(tg_chat_id) > 0:
-        url = f"https://api.telegram.org/bot{tg_api_key}/sendDocument"
+        url = f"{TELEGRAM_API_URL}/bot{tg_api_key}/sendDocument"
         files = {"document": open(filename, "rb")}
         params = {"chat_id": tg_chat_id}
-        res = requests.post(url, params = params, files=files)
+        with profile_stage("telegram"):
+            res = requests.post(url, params=params, files=files)
         if res.ok:
             logger.info(f"Отправлен файл {filename} в телеграм")
         else:
@@ -0,0 +1,70 @@
+import json
+import logging
+import threading
+import time
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_STATS_FILE = (
+    Path.home() / ".cache" / "litres_audiobooks_downloader" / "throughput.json"
+)
+# Скорость оценивается по последним RECENT_RUNS запускам
+RECENT_RUNS = 10
+# Короткие запуски дают случайную скорость, их не сохраняем
+MIN_RUN_BYTES = 10 * 1024 * 1024
+
+_transferred = 0
+_lock = threading.Lock()
+# Общий счетчик процессов загрузки (sharded_loader) и ячейка этого процесса в нем:
+# байты процессов суммирует родительский процесс, он и сохраняет статистику
+_shared_counter = None
+_shared_slot = 0
+
+
+def set_shared_counter(counter, slot):
+    global _shared_counter, _shared_slot
+    _shared_counter = counter
+    _shared_slot = slot
+
+
+def add_transferred(size):
+    global _transferred
+    with _lock:
+        _transferred += size
+        if _shared_counter is not None:
+            _shared_counter[_shared_slot] += size
+
+
+def get_transferred():
+    return _transferred
+
+
+def read_runs(stats_file=DEFAULT_STATS_FILE):
+    try:
+        return json.loads(Path(stats_file).read_text())["runs"]
+    except (OSError, ValueError, KeyError):
+        return []
+
+
+def record_run(seconds, stats_file=DEFAULT_STATS_FILE):
+    """Сохраняет объем загруженных за запуск байт и время загрузки"""
+    transferred = get_transferred()
+    if transferred < MIN_RUN_BYTES or seconds <= 0:
+        return
+    runs = read_runs(stats_file)
+    runs.append({"time": int(time.time()), "bytes": transferred, "seconds": seconds})
+    try:
+        Path(stats_file).parent.mkdir(exist_ok=True, parents=True)
+        Path(stats_file).write_text(json.dumps({"runs": runs[-RECENT_RUNS:]}))
+    except OSError as e:
+        logger.warning(f"Не удалось сохранить статистику загрузки {stats_file}: {e}")
+
+
+def get_recent_throughput(stats_file=DEFAULT_STATS_FILE):
+    """Средняя скорость последних запусков, байт/с. 0 - нет данных"""
+    runs = read_runs(stats_file)
+    seconds = sum(run["seconds"] for run in runs)
+    if seconds <= 0:
+        return 0
+    return sum(run["bytes"] for run in runs) / seconds